@@ -0,0 +1,374 @@
+"""
+Benchmarks the whole pipeline on synthetic mixtapes, away from production:
+everything lives in a temporary ROOT_DIR, ffmpeg and processid3.php are
+replaced by scripts that only wait and write placeholder outputs, and the
+database by SQLite. Reports the throughput of every stage, end to end
+throughput and peak RSS
+
+    python bench.py --mixtapes 4 --tracks 12 --track-size 8 --jobs 2
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import sqlite3
+import zipfile
+import resource
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+# MPEG 1 Layer III, 128kbps, 44.1kHz, joint stereo, no CRC
+FRAME_HEADER = b'\xff\xfb\x90\x44'
+FRAME_SIZE = 144 * 128000 // 44100
+COMMENT = u'downloaded from themixtapesite.com'
+# Tags the filter list cleans, so those tracks get their tags saved
+DIRTY_TITLE = u'Track %d (datpiff exclusive)'
+CLEAN_TITLE = u'Track %d'
+
+FAKE_FFMPEG = '''#!%(python)s
+# Stands in for ffmpeg: waits for a while, then writes half of its first
+# input to every output
+import os, sys, time
+args = sys.argv[1:]
+inputs = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == '-i']
+outputs = [arg for i, arg in enumerate(args)
+           if os.path.isabs(arg) and (i == 0 or args[i - 1] != '-i')]
+size = os.path.getsize(inputs[0])
+delay = %(latency)r + %(per_mb)r * size / 1048576.0
+if %(spin)r:
+    end = time.time() + delay
+    while time.time() < end:
+        pass
+else:
+    time.sleep(delay)
+for path in outputs:
+    with open(inputs[0], 'rb') as source:
+        with open(path, 'wb') as target:
+            target.write(source.read(max(size // 2, 1)))
+'''
+
+FAKE_PHP = '''#!%(python)s
+# Stands in for processid3.php
+import time
+time.sleep(%(latency)r)
+'''
+
+SCHEMA = '''
+CREATE TABLE tm1_posts (ID INTEGER PRIMARY KEY, post_title TEXT,
+                        post_status TEXT);
+CREATE TABLE tm1_postmeta (post_id INTEGER, meta_key TEXT, meta_value TEXT);
+'''
+
+
+def id3_frame(frame_id, data):
+    return frame_id + struct.pack('>I', len(data)) + b'\0\0' + data
+
+
+def id3_tag(artist, title, album, comment, padding=256):
+    """
+    Returns an ID3v2.3 tag with padding bytes of room to grow in place
+    """
+    frames = b''.join([
+        id3_frame(b'TPE1', b'\0' + artist.encode('latin-1')),
+        id3_frame(b'TIT2', b'\0' + title.encode('latin-1')),
+        id3_frame(b'TALB', b'\0' + album.encode('latin-1')),
+        id3_frame(b'COMM', b'\0eng\0' + comment.encode('latin-1')),
+    ])
+    size = len(frames) + padding
+    # The size is syncsafe, 7 bits per byte
+    header = b'ID3\x03\x00\x00' + struct.pack(
+        '>4B', *[(size >> shift) & 0x7f for shift in (21, 14, 7, 0)]
+    )
+    return header + frames + b'\0' * padding
+
+
+def write_track(path, size, artist, title, album):
+    """
+    Writes an MP3 of about size bytes: a tag, then silent frames
+    """
+    frame = FRAME_HEADER + b'\0' * (FRAME_SIZE - len(FRAME_HEADER))
+    frames = max(1, size // FRAME_SIZE)
+    with open(path, 'wb') as track:
+        track.write(id3_tag(artist, title, album, COMMENT))
+        # A thousand frames at a time, so memory use doesn't grow with size
+        for start in range(0, frames, 1000):
+            track.write(frame * min(1000, frames - start))
+
+
+def make_mixtape(path, number, tracks, track_size, dirty, compression):
+    """
+    Writes a ZIP of tracks MP3s of track_size bytes and a cover, the tags of
+    one track in every 1 / dirty needing to be cleaned
+    """
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+        mixtape = zipfile.ZipFile(path, 'w', compression)
+        try:
+            for i in range(tracks):
+                name = '%02d - Track %d.mp3' % (i + 1, i + 1)
+                track_path = os.path.join(work_dir, name)
+                is_dirty = dirty and int((i + 1) * dirty) > int(i * dirty)
+                title = (DIRTY_TITLE if is_dirty else CLEAN_TITLE) % (i + 1)
+                write_track(track_path, track_size, u'Artist %d' % number,
+                            title, u'Mixtape %d' % number)
+                mixtape.write(track_path, 'Mixtape %d/%s' % (number, name))
+                os.remove(track_path)
+            cover = b'\xff\xd8\xff\xe0' + b'\0' * 65536 + b'\xff\xd9'
+            mixtape.writestr('Mixtape %d/cover.jpg' % number, cover)
+        finally:
+            mixtape.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def write_script(path, template, **values):
+    values['python'] = sys.executable
+    with open(path, 'w') as script:
+        script.write(template % values)
+    os.chmod(path, 0o755)
+
+
+class Cursor(object):
+    """
+    Turns the MySQLdb %s placeholders of our queries into SQLite ones
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        return self.cursor.execute(sql.replace('%s', '?'), tuple(params or ()))
+
+    def executemany(self, sql, rows):
+        return self.cursor.executemany(sql.replace('%s', '?'), rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class SqlitePool(object):
+    """
+    Stands in for db.Pool, with one SQLite connection used a transaction at
+    a time
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def run(self, func, *args, **kwargs):
+        with self.lock:
+            try:
+                result = func(Cursor(self.db.cursor()), *args, **kwargs)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return result
+
+    def query(self, sql, params=None):
+        def execute(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return self.run(execute)
+
+    def add_post(self, post_id, title, url):
+        def insert(cur):
+            cur.execute('INSERT INTO tm1_posts VALUES (%s, %s, %s)',
+                        (post_id, title, 'pending'))
+            cur.executemany('INSERT INTO tm1_postmeta VALUES (%s, %s, %s)', [
+                (post_id, 'file_url', url),
+                (post_id, 'zipping_status', 'pending'),
+            ])
+        self.run(insert)
+
+
+def setup(root, options):
+    """
+    Lays out a ROOT_DIR in root, with fake tools, settings pointing at them
+    and the synthetic mixtapes. Returns the paths of the mixtapes
+    """
+    for name in ('data', 's3', 'bin'):
+        os.mkdir(os.path.join(root, name))
+    # What the server creates at startup
+    with open(os.path.join(root, 'mixtapes.counter'), 'w') as counter:
+        counter.write('0')
+    bin_dir = os.path.join(root, 'bin')
+    write_script(os.path.join(bin_dir, 'ffmpeg'), FAKE_FFMPEG,
+                 latency=options.ffmpeg_latency, per_mb=options.ffmpeg_per_mb,
+                 spin=options.spin)
+    write_script(os.path.join(bin_dir, 'processid3.php'), FAKE_PHP,
+                 latency=options.php_latency)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'local_settings.json')) as settings_file:
+        settings = json.load(settings_file)
+    settings['binaries'] = {
+        'ffmpeg': os.path.join(bin_dir, 'ffmpeg'),
+        'processid3': os.path.join(bin_dir, 'processid3.php'),
+    }
+    settings['uploads']['s3_path'] = os.path.join(root, 's3')
+    settings['processing']['concurrent_mixtapes'] = options.jobs
+    settings['processing']['preview_method'] = options.preview_method
+    settings['cache']['enabled'] = not options.no_cache
+    settings['metrics']['textfile'] = ''
+    if options.publish_window is not None:
+        settings['publishing']['window'] = options.publish_window
+    with open(os.path.join(root, 'settings.json'), 'w') as settings_file:
+        json.dump(settings, settings_file, indent=4)
+
+    compression = zipfile.ZIP_STORED if options.stored else zipfile.ZIP_DEFLATED
+    paths = []
+    for number in range(1, options.mixtapes + 1):
+        path = os.path.join(root, 'data', 'mixtape-%d.zip' % number)
+        make_mixtape(path, number, options.tracks,
+                     int(options.track_size * 1048576), options.dirty,
+                     compression)
+        paths.append(path)
+    return paths
+
+
+def stage_report(metrics, megabytes):
+    """
+    Returns a line per stage and scope: how often it ran, for how long and
+    how many MB of MP3s it gets through per second it is busy
+    """
+    with metrics.stage_seconds.lock:
+        values = dict((key, (counts[-1], total)) for key, (counts, total)
+                      in metrics.stage_seconds.values.items())
+    lines = []
+    stages = {}
+    for key in sorted(values, key=lambda key: (dict(key)['scope'], dict(key)['stage'])):
+        labels = dict(key)
+        count, total = values[key]
+        stages['%s/%s' % (labels['scope'], labels['stage'])] = {
+            'count': count, 'seconds': total,
+        }
+        lines.append('  %-8s %-14s %5d runs %9.2fs total %8.3fs mean %8.1fMB/s' % (
+            labels['scope'], labels['stage'], count, total,
+            total / max(count, 1), megabytes / max(total, 0.001)
+        ))
+    return lines, stages
+
+
+def run(options):
+    root = tempfile.mkdtemp(prefix='mixtapes-bench-', dir=options.dir)
+    # Set before the first import of util, which reads it to find ROOT_DIR and
+    # the settings
+    os.environ['MIXTAPES_ROOT'] = root
+    try:
+        generate_start = time.time()
+        paths = setup(root, options)
+        print('Generated %d mixtapes of %d tracks in %.2fs in %s' % (
+            len(paths), options.tracks, time.time() - generate_start, root
+        ))
+
+        import db
+        import metrics
+        import process
+        pool = SqlitePool(os.path.join(root, 'posts.db'))
+        db.pool = pool
+        for post_id, path in enumerate(paths, 1):
+            pool.add_post(post_id, 'Mixtape %d' % post_id,
+                          'http://example.com/uploads/' + os.path.basename(path))
+        # What the server passes on to process_zip
+        process.args = {'keep_dirs': False, 'keep_orig': True, 'save_rest': True}
+
+        def process_one(post_id):
+            try:
+                process.process_mixtape(post_id)
+                return True
+            except Exception as exc:
+                print('Mixtape %d failed: %s' % (post_id, exc))
+                return False
+
+        megabytes = sum(
+            process.zip_size(path) for path in paths
+        ) / 1048576.0
+        start = time.time()
+        jobs = ThreadPool(options.jobs)
+        try:
+            results = jobs.map(process_one, range(1, len(paths) + 1))
+        finally:
+            jobs.close()
+        elapsed = max(time.time() - start, 0.001)
+
+        tracks = len(paths) * options.tracks
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        lines, stages = stage_report(metrics, megabytes)
+        print('')
+        print('Stages (MB/s is MP3 input per busy second):')
+        for line in lines:
+            print(line)
+        print('')
+        print('End to end: %d/%d mixtapes, %d tracks, %.1fMB in %.2fs' % (
+            sum(results), len(results), tracks, megabytes, elapsed
+        ))
+        print('  %.2f mixtapes/min, %.2f tracks/s, %.1fMB/s' % (
+            len(paths) * 60 / elapsed, tracks / elapsed, megabytes / elapsed
+        ))
+        print('Peak RSS: %dkB, largest child %dkB' % (self_rss, children_rss))
+
+        if options.json:
+            with open(options.json, 'w') as json_file:
+                json.dump({
+                    'options': vars(options),
+                    'mixtapes': len(paths),
+                    'failed': len(results) - sum(results),
+                    'tracks': tracks,
+                    'megabytes': megabytes,
+                    'seconds': elapsed,
+                    'stages': stages,
+                    'max_rss_kb': self_rss,
+                    'children_max_rss_kb': children_rss,
+                }, json_file, indent=4, sort_keys=True)
+        return all(results)
+    finally:
+        if options.keep:
+            print('Kept %s' % root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks processing\
+        synthetic mixtapes with stand-ins for ffmpeg, PHP and MySQL')
+    parser.add_argument('-m', '--mixtapes', type=int, default=4,
+                        help='Number of mixtapes to process')
+    parser.add_argument('-t', '--tracks', type=int, default=12,
+                        help='Tracks per mixtape')
+    parser.add_argument('-s', '--track-size', type=float, default=8,
+                        help='Size of each track in MB')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Mixtapes processed at once')
+    parser.add_argument('--dirty', type=float, default=0.5,
+                        help='Share of tracks whose tags need cleaning')
+    parser.add_argument('--stored', action='store_true', default=False,
+                        help='Store the tracks in the ZIPs without compression')
+    parser.add_argument('--ffmpeg-latency', type=float, default=0.2,
+                        help='Seconds every fake ffmpeg run takes')
+    parser.add_argument('--ffmpeg-per-mb', type=float, default=0.05,
+                        help='Extra seconds per MB of input for fake ffmpeg')
+    parser.add_argument('--spin', action='store_true', default=False,
+                        help='Make fake ffmpeg burn CPU instead of sleeping')
+    parser.add_argument('--php-latency', type=float, default=0.5,
+                        help='Seconds every fake processid3.php run takes')
+    parser.add_argument('--preview-method', choices=('native', 'ffmpeg'),
+                        default='native', help='How previews are made')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Disable the transcode cache')
+    parser.add_argument('--publish-window', type=float,
+                        help='Seconds the publisher waits to batch posts')
+    parser.add_argument('--dir', help='Where to make the temporary ROOT_DIR')
+    parser.add_argument('--json', help='Also write the results to this file')
+    parser.add_argument('-k', '--keep', action='store_true', default=False,
+                        help="Keep the temporary ROOT_DIR")
+    sys.exit(0 if run(parser.parse_args()) else 1)
@@ -0,0 +1,122 @@
+import os
+import errno
+import shutil
+import hashlib
+import threading
+
+from util import debug
+
+
+def link(src, dst):
+    """
+    Hardlinks src to dst, copying instead if they're on different devices
+    """
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy(src, dst)
+
+
+class TrackCache(object):
+    """
+    Content-addressed store of transcoded tracks. Outputs are filed under the
+    hash of the source file plus the parameters they were encoded with, and
+    hardlinked in and out of the store. Once the store grows past max_size
+    bytes, the least recently used entries are evicted
+    """
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def key(self, source_hash, *params):
+        """
+        Returns the key of outputs made from a source whose content hashes to
+        source_hash, with params, so the source never has to be read again
+        """
+        digest = hashlib.sha1(source_hash.encode('utf-8'))
+        for param in params:
+            digest.update(b'\0' + param.encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key, kind):
+        return os.path.join(self.root, key[:2], '%s.%s' % (key, kind))
+
+    def fetch(self, key, targets):
+        """
+        Links the cached outputs for key to targets, a dict of kinds to paths
+        Returns False, linking nothing, unless every kind is cached
+        """
+        paths = dict((kind, self.path(key, kind)) for kind in targets)
+        if not all(os.path.exists(path) for path in paths.values()):
+            return False
+        try:
+            for kind, target in targets.items():
+                # Bump the mtime, which is what eviction orders entries by
+                os.utime(paths[kind], None)
+                link(paths[kind], target)
+        except OSError as exc:
+            # Evicted while we were linking it
+            debug("Cache entry %s went away: %s" % (key, exc))
+            for target in targets.values():
+                if os.path.exists(target):
+                    os.remove(target)
+            return False
+        debug("Cache hit for %s" % key)
+        return True
+
+    def store(self, key, sources):
+        """
+        Files the outputs in sources, a dict of kinds to paths, under key
+        """
+        directory = os.path.join(self.root, key[:2])
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        added = 0
+        for kind, source in sources.items():
+            path = self.path(key, kind)
+            temp_path = '%s.%d.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            link(source, temp_path)
+            os.rename(temp_path, path)
+            added += os.path.getsize(path)
+        with self.lock:
+            if self.size is not None:
+                self.size += added
+            if self.size is None or self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the store fits in max_size
+        Must be called with the lock held
+        """
+        entries = {}
+        total = 0
+        for directory, _, fnames in os.walk(self.root):
+            for fname in fnames:
+                path = os.path.join(directory, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = fname.split('.')[0]
+                size, mtime, paths = entries.get(key, (0, 0, []))
+                entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime), paths + [path])
+                total += stat.st_size
+        for key, (size, mtime, paths) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if total <= self.max_size:
+                break
+            debug("Evicting %s from the track cache" % key)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        self.size = total
@@ -0,0 +1,79 @@
+import os
+import errno
+import fcntl
+from contextlib import contextmanager
+
+from util import ROOT_DIR, debug
+
+
+class CounterAllocator(object):
+    """
+    Hands out mixtape directory numbers from the counter file at path.
+    Allocation holds an exclusive flock on path.lock, so that processes and
+    threads never get the same number, and the new value is written to a
+    temporary file, fsynced and renamed over the counter, so that a crash
+    leaves either the old value or the new one
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def locked(self):
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def read(self):
+        with open(self.path, 'r') as counter:
+            return int(counter.read())
+
+    def write(self, value):
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'w') as counter:
+            counter.write(str(value))
+            counter.flush()
+            os.fsync(counter.fileno())
+        os.rename(temp_path, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def ensure(self):
+        """
+        Creates the counter at 0 if it doesn't exist yet. Any other failure
+        to read it is raised: starting over at 0 would hand out numbers
+        already published
+        """
+        with self.locked():
+            try:
+                self.read()
+            except (IOError, OSError) as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                debug("Creating mixtape counter at %s" % self.path)
+                self.write(0)
+            except ValueError:
+                raise ValueError("Mixtape counter at %s is corrupt, fix it by "
+                                 "hand before starting" % self.path)
+
+    def allocate(self, count=1):
+        """
+        Reserves count consecutive numbers and returns the first one
+        """
+        with self.locked():
+            first = self.read() + 1
+            self.write(first + count - 1)
+        debug("Allocated mixtape numbers %d to %d" % (first, first + count - 1))
+        return first
+
+
+def get_counter():
+    """
+    Returns the allocator for the mixtape counter in ROOT_DIR
+    """
+    return CounterAllocator(os.path.join(ROOT_DIR, 'mixtapes.counter'))
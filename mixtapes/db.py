@@ -0,0 +1,157 @@
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from util import debug, get_config
+
+pool = None
+pool_lock = threading.Lock()
+# MySQL error codes for a table or a column that doesn't exist
+SCHEMA_ERRORS = (1146, 1054)
+
+
+def is_schema_error(exc):
+    """
+    Whether exc is MySQL saying a table or column doesn't exist, which
+    means the settings are wrong rather than the database having a hiccup
+    """
+    return bool(exc.args) and exc.args[0] in SCHEMA_ERRORS
+
+
+class Pool(object):
+    """
+    A bounded pool of MySQL connections shared by every thread. Idle
+    connections are pinged before being handed out again, and replaced if they
+    went away
+    """
+    def __init__(self, size=4, retries=5, backoff=0.5, max_backoff=30,
+                 **connect_args):
+        # Imported on first use, so that importing db costs nothing
+        import MySQLdb
+        self.mysql = MySQLdb
+        # Errors worth trying again: lost connections, deadlocks, lock wait
+        # timeouts
+        self.retry_errors = (MySQLdb.OperationalError, MySQLdb.InterfaceError)
+        self.connect_args = connect_args
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        debug("Connecting to MySQL database")
+        return self.mysql.connect(**self.connect_args)
+
+    def healthy(self, conn):
+        try:
+            conn.ping()
+            return True
+        except self.mysql.Error:
+            return False
+
+    def acquire(self):
+        """
+        Returns a live connection, waiting for a free slot if needed
+        """
+        self.slots.acquire()
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if self.healthy(conn):
+                return conn
+            self.discard(conn)
+            return self.connect()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self.discard(conn)
+        else:
+            self.idle.put(conn)
+        self.slots.release()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except self.mysql.Error:
+            pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a cursor, commits if the block finishes and rolls back if not
+        """
+        conn = self.acquire()
+        broken = False
+        try:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            conn.commit()
+        except Exception as exc:
+            broken = isinstance(exc, self.retry_errors)
+            try:
+                conn.rollback()
+            except self.mysql.Error:
+                broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls func with a cursor inside a transaction, retrying the whole
+        transaction with exponential backoff when the database hiccups.
+        Schema errors are raised at once
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.transaction() as cur:
+                    return func(cur, *args, **kwargs)
+            except self.retry_errors as exc:
+                if is_schema_error(exc):
+                    # Trying again won't make a missing table or column appear
+                    raise
+                attempt += 1
+                if attempt > self.retries:
+                    debug("MySQL error: %s; giving up after %d tries" % (exc, attempt))
+                    raise
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                debug("MySQL error: %s; trying again in %.2fs" % (exc, delay))
+                time.sleep(delay)
+
+    def query(self, sql, params=None):
+        """
+        Runs a single parameterized statement and returns every row
+        """
+        def execute(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return self.run(execute)
+
+
+def get_pool():
+    """
+    Returns the pool shared by the process, set up from the database and
+    database_pool sections of the settings
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            config = get_config()
+            options = dict(config.get('database_pool', {}))
+            options.update(config['database'])
+            pool = Pool(**options)
+    return pool
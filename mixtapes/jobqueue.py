@@ -0,0 +1,296 @@
+import os
+import time
+import sqlite3
+import threading
+
+from util import ROOT_DIR, debug, get_config
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue(object):
+    """
+    A queue of jobs kept in SQLite, so that nothing queued is lost when the
+    process stops. Every job has a unique key (e.g. a post ID): adding a key
+    that is already queued does nothing, adding one that is running queues it
+    again once it ends, as the run may have missed what changed, and adding
+    one that is done or failed queues it again. Failed jobs are retried up to
+    max_attempts times, retry_delay seconds apart
+    """
+    def __init__(self, path, table='jobs', max_attempts=3, retry_delay=60):
+        self.path = path
+        self.table = table
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'key TEXT NOT NULL UNIQUE, '
+            'payload TEXT, '
+            'state TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'available REAL NOT NULL DEFAULT 0, '
+            'progress TEXT, '
+            'error TEXT, '
+            'created REAL NOT NULL, '
+            'updated REAL NOT NULL)' % table
+        )
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(%s)' % table)]
+        if 'requeue' not in columns:
+            # Queues made before jobs could be queued again while running
+            self.db.execute('ALTER TABLE %s ADD COLUMN '
+                            'requeue INTEGER NOT NULL DEFAULT 0' % table)
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql % self.table, params).fetchall()
+
+    def add(self, key, payload=None):
+        """
+        Queues key, returns (job id, state, whether it was queued by this call)
+        """
+        return self.add_many([key], payload)[0]
+
+    def add_many(self, keys, payload=None):
+        """
+        Queues every key in a single transaction, returns what add would for
+        each of them
+        """
+        now = time.time()
+        results = []
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for key in keys:
+                    row = self.db.execute(
+                        'SELECT id, state FROM %s WHERE key = ?' % self.table,
+                        (str(key),)
+                    ).fetchone()
+                    if row is None:
+                        cursor = self.db.execute(
+                            'INSERT INTO %s (key, payload, state, created, updated) '
+                            'VALUES (?, ?, ?, ?, ?)' % self.table,
+                            (str(key), payload, QUEUED, now, now)
+                        )
+                        results.append((cursor.lastrowid, QUEUED, True))
+                    elif row[1] == QUEUED:
+                        results.append((row[0], row[1], False))
+                    elif row[1] == RUNNING:
+                        self.db.execute(
+                            'UPDATE %s SET requeue = 1, payload = ?, '
+                            'updated = ? WHERE id = ?' % self.table,
+                            (payload, now, row[0])
+                        )
+                        results.append((row[0], row[1], True))
+                    else:
+                        self.db.execute(
+                            'UPDATE %s SET state = ?, payload = ?, attempts = 0, '
+                            'available = 0, progress = NULL, error = NULL, '
+                            'updated = ? WHERE id = ?' % self.table,
+                            (QUEUED, payload, now, row[0])
+                        )
+                        results.append((row[0], QUEUED, True))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        for key, (job_id, state, _) in zip(keys, results):
+            debug("Job %s for %s is %s" % (job_id, key, state))
+        return results
+
+    def recover(self):
+        """
+        Queues again the jobs that were running when the process stopped,
+        unless they have already been tried max_attempts times: a job that
+        brings the process down would otherwise be retried on every start
+        Returns the number of jobs queued again
+        """
+        now = time.time()
+        rows = self.execute(
+            'SELECT id, key, attempts FROM %s WHERE state = ?', (RUNNING,)
+        )
+        resumed = 0
+        for job_id, key, attempts in rows:
+            if attempts >= self.max_attempts:
+                debug("Giving up on job %s for %s after %d attempts" % (
+                    job_id, key, attempts
+                ))
+                self.execute(
+                    'UPDATE %s SET state = ?, error = ?, updated = ? WHERE id = ?',
+                    (FAILED, 'interrupted on attempt %d' % attempts, now, job_id)
+                )
+            else:
+                debug("Resuming job %s for %s" % (job_id, key))
+                self.execute(
+                    'UPDATE %s SET state = ?, requeue = 0, updated = ? '
+                    'WHERE id = ?',
+                    (QUEUED, now, job_id)
+                )
+                resumed += 1
+        return resumed
+
+    def claim(self):
+        """
+        Marks the oldest job that is ready to run as running
+        Returns (job id, key, payload), or None if there is nothing to do
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT id, key, payload FROM %s WHERE state = ? AND '
+                    'available <= ? ORDER BY id LIMIT 1' % self.table,
+                    (QUEUED, now)
+                ).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        'UPDATE %s SET state = ?, attempts = attempts + 1, '
+                        'progress = NULL, updated = ? WHERE id = ?' % self.table,
+                        (RUNNING, now, row[0])
+                    )
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return row
+
+    def next_available(self):
+        """
+        Returns when the next queued job becomes ready to run, None if
+        nothing is queued
+        """
+        return self.execute(
+            'SELECT MIN(available) FROM %s WHERE state = ?', (QUEUED,)
+        )[0][0]
+
+    def end(self, job_id, state, error=None, delay=0):
+        """
+        Moves job_id out of running to state, or queues it afresh instead if
+        it was added again while running. Returns the state it ends up in
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                requeue = self.db.execute(
+                    'SELECT requeue FROM %s WHERE id = ?' % self.table,
+                    (job_id,)
+                ).fetchone()[0]
+                if requeue:
+                    state = QUEUED
+                    self.db.execute(
+                        'UPDATE %s SET state = ?, requeue = 0, attempts = 0, '
+                        'available = 0, progress = NULL, error = NULL, '
+                        'updated = ? WHERE id = ?' % self.table,
+                        (state, now, job_id)
+                    )
+                else:
+                    self.db.execute(
+                        'UPDATE %s SET state = ?, error = ?, available = ?, '
+                        'updated = ? WHERE id = ?' % self.table,
+                        (state, error, now + delay, now, job_id)
+                    )
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        if requeue:
+            debug("Job %s was added again while running, queued again" % job_id)
+        return state
+
+    def finish(self, job_id):
+        return self.end(job_id, DONE)
+
+    def fail(self, job_id, error):
+        """
+        Queues job_id again after retry_delay, or marks it as failed if it has
+        been tried max_attempts times. Returns the new state
+        """
+        attempts = self.execute(
+            'SELECT attempts FROM %s WHERE id = ?', (job_id,)
+        )[0][0]
+        if attempts < self.max_attempts:
+            state = QUEUED
+        else:
+            state = FAILED
+        state = self.end(job_id, state, str(error), self.retry_delay * attempts)
+        debug("Job %s failed (attempt %d): %s" % (job_id, attempts, error))
+        return state
+
+    def set_progress(self, job_id, progress):
+        self.execute(
+            'UPDATE %s SET progress = ?, updated = ? WHERE id = ?',
+            (progress, time.time(), job_id)
+        )
+
+    def depth(self):
+        """
+        Returns the number of jobs in each state
+        """
+        counts = dict((state, 0) for state in (QUEUED, RUNNING, DONE, FAILED))
+        counts.update(self.execute(
+            'SELECT state, COUNT(*) FROM %s GROUP BY state'
+        ))
+        return counts
+
+    def jobs(self, states=(QUEUED, RUNNING, FAILED)):
+        """
+        Returns (id, key, state, attempts, progress, error, updated) for every
+        job in one of states
+        """
+        return self.execute(
+            'SELECT id, key, state, attempts, progress, error, updated '
+            'FROM %s WHERE state IN (' + ', '.join('?' * len(states)) +
+            ') ORDER BY id', tuple(states)
+        )
+
+    def job(self, job_id):
+        rows = self.execute(
+            'SELECT id, key, state, attempts, progress, error, updated '
+            'FROM %s WHERE id = ?', (job_id,)
+        )
+        return rows[0] if rows else None
+
+    def report(self):
+        """
+        Returns a human readable summary of the queue depth and of every job
+        that isn't done
+        """
+        depth = self.depth()
+        lines = ['Queue depth: %d queued, %d running, %d done, %d failed' % (
+            depth[QUEUED], depth[RUNNING], depth[DONE], depth[FAILED]
+        )]
+        for job_id, key, state, attempts, progress, error, updated in self.jobs():
+            line = 'job %s for %s: %s (attempt %d, updated %s)' % (
+                job_id, key, state, attempts,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated))
+            )
+            if progress:
+                line += ' - %s' % progress
+            if error:
+                line += ' - last error: %s' % error
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def get_job_queue():
+    """
+    Opens the mixtape queue at queue.path (ROOT_DIR/queue.db by default)
+    """
+    options = get_config().get('queue', {})
+    return JobQueue(
+        options.get('path') or os.path.join(ROOT_DIR, 'queue.db'),
+        max_attempts=options.get('max_attempts', 3),
+        retry_delay=options.get('retry_delay', 60)
+    )
@@ -0,0 +1,113 @@
+import os
+import errno
+import json
+
+from util import ROOT_DIR, debug
+
+
+def remote_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class Manifest(object):
+    """
+    What was published for a post: the mixtape number it was uploaded to, the
+    name of its archive, the parameters its outputs were made with (see
+    process.output_params) and, for every track,
+    the CRC and size of its member in the uploaded ZIP along with the size of
+    every file made from it (relative to the mixtape's directory)
+    """
+    def __init__(self, post_id, count, archive=None, params=None, tracks=None):
+        self.post_id = post_id
+        self.count = count
+        self.archive = archive
+        self.params = params
+        self.tracks = tracks or {}
+
+    @staticmethod
+    def path(post_id):
+        return os.path.join(ROOT_DIR, 'manifests', '%s.json' % post_id)
+
+    @classmethod
+    def load(cls, post_id):
+        """
+        Returns the manifest of post_id, None if it was never published
+        """
+        try:
+            with open(cls.path(post_id)) as manifest_file:
+                data = json.load(manifest_file)
+        except (IOError, OSError, ValueError):
+            return None
+        return cls(post_id, data['count'], data.get('archive'),
+                   data.get('params'), data.get('tracks'))
+
+    def save(self):
+        path = self.path(self.post_id)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({
+                'count': self.count,
+                'archive': self.archive,
+                'params': self.params,
+                'tracks': self.tracks,
+            }, manifest_file, indent=4, sort_keys=True)
+        os.rename(temp_path, path)
+
+    def add_track(self, name, zinfo, outputs, remote_dir):
+        """
+        Records the outputs of name, uploaded to remote_dir, along with their
+        sizes there
+        """
+        self.tracks[name] = {
+            'crc': zinfo.CRC,
+            'size': zinfo.file_size,
+            'outputs': dict(
+                (output, os.path.getsize(os.path.join(remote_dir, output)))
+                for output in outputs
+            ),
+        }
+
+    def reusable(self, name, zinfo, params, remote_dir):
+        """
+        Whether the outputs of name can be kept as they are: its member and
+        the parameters, filter list included, haven't changed, and its
+        outputs are still there with the sizes they were uploaded with.
+        Manifests from before sizes were recorded never match
+        """
+        track = self.tracks.get(name)
+        return (
+            track is not None and
+            params == self.params and
+            track['crc'] == zinfo.CRC and
+            track['size'] == zinfo.file_size and
+            isinstance(track['outputs'], dict) and
+            all(remote_size(os.path.join(remote_dir, output)) == size
+                for output, size in track['outputs'].items())
+        )
+
+    def remove_stale(self, remote_dir, names, archive):
+        """
+        Deletes from remote_dir the outputs of tracks that are no longer in
+        names, and the old archive if it isn't called archive anymore
+        """
+        stale = []
+        for name, track in self.tracks.items():
+            if name not in names:
+                stale.extend(track['outputs'])
+        if self.archive and self.archive != archive:
+            stale.append(self.archive)
+        for output in stale:
+            debug('Removing stale "%s"' % output)
+            try:
+                os.remove(os.path.join(remote_dir, output))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
@@ -0,0 +1,168 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds, in seconds, of the duration histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """
+    A monotonically increasing count, one per set of labels
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key in sorted(values):
+            yield self.name, key, values[key]
+
+
+class Histogram(object):
+    """
+    Observed values counted into cumulative buckets, one set per labels
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = dict((key, (list(counts), total))
+                          for key, (counts, total) in self.values.items())
+        for key in sorted(values):
+            counts, total = values[key]
+            for bound, count in zip(self.buckets, counts):
+                yield (self.name + '_bucket', key,
+                       count, (('le', format_value(bound)),))
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, counts[-1]
+
+
+class Registry(object):
+    """
+    Every metric of the process, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for sample in metric.samples():
+                name, labels, value = sample[:3]
+                extra = sample[3] if len(sample) > 3 else ()
+                lines.append('%s%s %s' % (
+                    name, format_labels(labels, extra), format_value(value)
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the metrics to path, replacing it atomically so a scraper
+        never reads half a file
+        """
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temp_path, path)
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+    'mixtapes_stage_seconds',
+    'Time spent in each processing stage, per track or per mixtape'
+)
+tracks_total = registry.counter(
+    'mixtapes_tracks_total', 'Tracks processed, by result'
+)
+mixtapes_total = registry.counter(
+    'mixtapes_mixtapes_total', 'Mixtapes processed, by result'
+)
+bytes_total = registry.counter(
+    'mixtapes_bytes_total', 'Bytes moved, by stage'
+)
+process_seconds = registry.histogram(
+    'mixtapes_process_seconds', 'Run time of external commands'
+)
+process_cpu_seconds_total = registry.counter(
+    'mixtapes_process_cpu_seconds_total', 'CPU time used by external commands'
+)
+processes_total = registry.counter(
+    'mixtapes_processes_total', 'External commands run, by result'
+)
+queue_seconds = registry.histogram(
+    'mixtapes_queue_seconds', 'Time tasks wait for a worker, by pipeline stage'
+)
+videos_total = registry.counter(
+    'mixtapes_videos_total', 'Preview videos made for YouTube, by result'
+)
+
+
+@contextmanager
+def timed(stage, scope='track'):
+    """
+    Records how long the with block takes as stage, in the given scope
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.time() - start, stage=stage, scope=scope)
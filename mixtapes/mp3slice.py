@@ -0,0 +1,176 @@
+import mmap
+import struct
+from collections import namedtuple
+
+
+# Bitrates in kbps by bitrate index, for each (MPEG version, layer) family
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates by sample rate index, for MPEG 1, 2 and 2.5
+SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    25: (11025, 12000, 8000),
+}
+# The two version bits of the header: 00 is MPEG 2.5, 01 is reserved
+VERSIONS = {0: 25, 2: 2, 3: 1}
+# The two layer bits: 00 is reserved
+LAYERS = {1: 3, 2: 2, 3: 1}
+# How far to look for the first frame, or for the next one after junk
+MAX_SCAN = 64 * 1024
+
+Frame = namedtuple('Frame', 'offset length samples sample_rate version layer mono')
+
+
+def parse_frame(data, offset):
+    """
+    Returns the Frame whose header is at offset in data, None if there is no
+    valid header there
+    """
+    if offset + 4 > len(data):
+        return None
+    header = struct.unpack('>I', data[offset:offset + 4])[0]
+    if header & 0xffe00000 != 0xffe00000:
+        return None
+    version = VERSIONS.get((header >> 19) & 3)
+    layer = LAYERS.get((header >> 17) & 3)
+    bitrate_index = (header >> 12) & 15
+    rate_index = (header >> 10) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or rate_index == 3:
+        # Free format bitrates are valid, but their frames can't be sized
+        return None
+    bitrate = BITRATES[(min(version, 2), layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (header >> 9) & 1
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    mono = (header >> 6) & 3 == 3
+    return Frame(offset, length, samples, sample_rate, version, layer, mono)
+
+
+def id3v2_end(data):
+    """
+    Returns the offset right after the ID3v2 tags at the start of data
+    """
+    offset = 0
+    while data[offset:offset + 3] == b'ID3' and offset + 10 <= len(data):
+        flags = struct.unpack('>B', data[offset + 5:offset + 6])[0]
+        size = 0
+        for byte in struct.unpack('>4B', data[offset + 6:offset + 10]):
+            # Syncsafe, 7 bits per byte
+            size = (size << 7) | (byte & 0x7f)
+        offset += 10 + size + (10 if flags & 0x10 else 0)
+    return offset
+
+
+def find_frame(data, offset, like=None):
+    """
+    Returns the first frame at or after offset, within MAX_SCAN bytes, that
+    is followed by another frame of the same stream (or matches like)
+    """
+    end = min(len(data), offset + MAX_SCAN)
+    while offset < end:
+        offset = data.find(b'\xff', offset, end)
+        if offset == -1:
+            return None
+        frame = parse_frame(data, offset)
+        if frame is not None:
+            following = like or parse_frame(data, offset + frame.length)
+            if following is None and offset + frame.length == len(data):
+                # The last frame of the file
+                following = frame
+            if following is not None and same_stream(frame, following):
+                return frame
+        offset += 1
+    return None
+
+
+def same_stream(frame, other):
+    return (frame.version, frame.layer, frame.sample_rate) == (
+        other.version, other.layer, other.sample_rate)
+
+
+def is_info_frame(data, frame):
+    """
+    Whether frame is the Xing, Info or VBRI frame encoders put first, which
+    holds no audio but the frame count and seek table of the whole file
+    """
+    if frame.version == 1:
+        side_info = 17 if frame.mono else 32
+    else:
+        side_info = 9 if frame.mono else 17
+    xing = frame.offset + 4 + side_info
+    vbri = frame.offset + 4 + 32
+    return (data[xing:xing + 4] in (b'Xing', b'Info') or
+            data[vbri:vbri + 4] == b'VBRI')
+
+
+def preview_spans(data, seconds):
+    """
+    Returns where the ID3v2 tags at the start of data end, and the spans of
+    the frames making up its first seconds of audio
+    """
+    tags_end = id3v2_end(data)
+    first = find_frame(data, tags_end)
+    if first is None:
+        raise ValueError("no MPEG audio frames found")
+    spans = []
+    offset = first.offset
+    if is_info_frame(data, first):
+        # Its counts would be those of the whole file, not of the preview
+        offset += first.length
+    start = offset
+    samples = 0
+    wanted = seconds * first.sample_rate
+    while samples < wanted:
+        frame = parse_frame(data, offset)
+        if frame is None or not same_stream(frame, first):
+            if offset > start:
+                spans.append((start, offset))
+            frame = find_frame(data, offset, like=first)
+            if frame is None:
+                # The end of the audio, or junk we can't get past
+                return tags_end, spans
+            start = offset = frame.offset
+        if offset + frame.length > len(data):
+            # A truncated last frame
+            break
+        samples += frame.samples
+        offset += frame.length
+    if offset > start:
+        spans.append((start, offset))
+    return tags_end, spans
+
+
+def slice_file(source_path, target_path, seconds=30):
+    """
+    Writes the ID3v2 tags and the first seconds of audio frames of the MP3 at
+    source_path to target_path, without decoding anything. Only the tags and
+    frames copied are read, through mmap. Raises ValueError if source_path
+    doesn't look like an MP3
+    """
+    with open(source_path, 'rb') as source:
+        try:
+            data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError("%s is empty" % source_path)
+        try:
+            tags_end, spans = preview_spans(data, seconds)
+            if not spans:
+                raise ValueError("no audio frames in %s" % source_path)
+            with open(target_path, 'wb') as target:
+                target.write(data[:tags_end])
+                for start, end in spans:
+                    target.write(data[start:end])
+        finally:
+            data.close()
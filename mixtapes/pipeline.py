@@ -0,0 +1,226 @@
+import math
+import time
+import threading
+from collections import deque
+
+from util import debug, get_config
+import metrics
+
+
+# Kinds of stages, which decide how many workers they get by default
+CPU = 'cpu'
+IO = 'io'
+NETWORK = 'network'
+
+stages = {}
+stages_lock = threading.Lock()
+
+
+def default_limits(kind, cores):
+    """
+    Returns (min workers, max workers, queue size) for a stage of kind
+    CPU stages never run more tasks than there are cores, I/O stages mostly
+    wait on the disk so they get a few workers per core, and network stages
+    wait on remote hosts whatever the number of cores
+    """
+    if kind == CPU:
+        return 1, cores, cores * 2
+    if kind == IO:
+        return 1, cores * 4, cores * 16
+    return 1, 16, 64
+
+
+def ewma(average, value, alpha=0.2):
+    if average is None:
+        return value
+    return average + alpha * (value - average)
+
+
+class Task(object):
+    """
+    A function submitted to a Stage, and its eventual result
+    """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.submitted = time.time()
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as exc:
+            self.error = exc
+        self.event.set()
+
+    def ready(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        Waits for the task and returns its result, raising what it raised
+        """
+        self.event.wait(timeout)
+        if not self.ready():
+            raise RuntimeError("Task still running after %ss" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Stage(object):
+    """
+    A bounded queue of tasks of one kind and the threads running them.
+    submit blocks while queue_size tasks are waiting, so whoever feeds the
+    stage can't get further ahead than that. Waiting tasks get a new worker,
+    up to as many as the stage needs to keep up with the rate tasks arrive at
+    given how long they take (Little's law), or up to max_workers while the
+    queue is full. Workers retire after idle_timeout seconds without work,
+    down to min_workers
+    """
+    def __init__(self, name, kind, min_workers, max_workers, queue_size,
+                 idle_timeout=30.0):
+        self.name = name
+        self.kind = kind
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.queue_size = max(1, queue_size)
+        self.idle_timeout = idle_timeout
+        self.tasks = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.workers = 0
+        self.idle = 0
+        self.completed = 0
+        # Moving averages of how long tasks take, and of the time between
+        # two tasks being submitted
+        self.latency = None
+        self.interval = None
+        self.last_submit = None
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args), waiting for room in the queue first
+        Returns a Task to get the result from
+        """
+        task = Task(func, args)
+        with self.lock:
+            while len(self.tasks) >= self.queue_size:
+                self.not_full.wait()
+            if self.last_submit is not None:
+                self.interval = ewma(self.interval, task.submitted - self.last_submit)
+            self.last_submit = task.submitted
+            self.tasks.append(task)
+            self.grow()
+            self.not_empty.notify()
+        return task
+
+    def wanted(self):
+        """
+        Returns how many workers the stage needs, from what was observed
+        """
+        if len(self.tasks) >= self.queue_size:
+            return self.max_workers
+        if self.latency is None or not self.interval:
+            # Nothing measured yet, one worker per waiting task
+            return self.workers + len(self.tasks)
+        return int(math.ceil(self.latency / self.interval))
+
+    def grow(self):
+        """
+        Starts a worker if tasks are waiting for one. Called with lock held
+        """
+        limit = min(self.max_workers, max(self.min_workers, self.wanted()))
+        if len(self.tasks) > self.idle and self.workers < limit:
+            self.workers += 1
+            worker = threading.Thread(
+                target=self.work, name='%s-%d' % (self.name, self.workers)
+            )
+            worker.daemon = True
+            worker.start()
+
+    def next_task(self):
+        """
+        Returns the next task, or None once this worker should retire
+        """
+        with self.lock:
+            self.idle += 1
+            try:
+                deadline = time.time() + self.idle_timeout
+                while not self.tasks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        if self.workers > self.min_workers:
+                            self.workers -= 1
+                            return None
+                        deadline = time.time() + self.idle_timeout
+                        remaining = self.idle_timeout
+                    self.not_empty.wait(remaining)
+                task = self.tasks.popleft()
+                self.not_full.notify()
+                return task
+            finally:
+                self.idle -= 1
+
+    def work(self):
+        while True:
+            task = self.next_task()
+            if task is None:
+                return
+            start = time.time()
+            metrics.queue_seconds.observe(start - task.submitted, stage=self.name)
+            task.run()
+            with self.lock:
+                self.latency = ewma(self.latency, time.time() - start)
+                self.completed += 1
+                # Keep up with a backlog that built while every worker was busy
+                self.grow()
+
+    def describe(self):
+        with self.lock:
+            return '%s (%s): %d workers, %d idle, %d queued, %d done, %s per task' % (
+                self.name, self.kind, self.workers, self.idle, len(self.tasks),
+                self.completed,
+                '%.2fs' % self.latency if self.latency is not None else 'n/a'
+            )
+
+
+def get_stage(name, kind):
+    """
+    Returns the stage called name shared by every mixtape on this host,
+    creating it as a stage of kind. Its limits default to those of its kind
+    for the cores of the host, and are overridden by pipeline.<name>
+    (min_workers, max_workers, queue_size and idle_timeout) in the settings,
+    where 0 keeps the default
+    """
+    with stages_lock:
+        if name not in stages:
+            from multiprocessing import cpu_count
+            options = get_config().get('pipeline', {}).get(name, {})
+            min_workers, max_workers, queue_size = default_limits(kind, cpu_count())
+            stage = Stage(
+                name, kind,
+                min_workers=options.get('min_workers') or min_workers,
+                max_workers=options.get('max_workers') or max_workers,
+                queue_size=options.get('queue_size') or queue_size,
+                idle_timeout=options.get('idle_timeout') or 30.0
+            )
+            debug("Starting %s stage with up to %d workers and %d queued tasks" % (
+                name, stage.max_workers, stage.queue_size
+            ))
+            stages[name] = stage
+        return stages[name]
+
+
+def describe():
+    """
+    Returns a line about the workers and queue of every stage
+    """
+    with stages_lock:
+        return [stages[name].describe() for name in sorted(stages)]
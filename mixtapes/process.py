@@ -1,22 +1,52 @@
 #!/usr/bin/python
-import timing
+import time
 import zipfile
 import os
 import pipes
 import shlex
 import glob
 import shutil
+import errno
+import struct
+import copy
+import tempfile
+import threading
+import json
+import hashlib
 
-from twisted.internet.threads import blockingCallFromThread
-from twisted.internet.utils import getProcessValue
-import MySQLdb
-import eyed3
-
-from util import ROOT_DIR, debug, get_config, get_filter_list, filter_string
+from util import ROOT_DIR, debug, config, filter_engine
+from db import get_pool
+from publish import BatchPublisher
+from cache import TrackCache
+from counter import get_counter
+from manifest import Manifest
+from workspace import get_workspace
+from youtube import get_lane as get_video_lane
+import metrics
+from metrics import timed
+from procutil import run_blocking
+from pipeline import get_stage, CPU, IO
+import pipeline
+import mp3slice
 
 
 reactor = None
-config = get_config()
+publisher = None
+track_cache = None
+process_runner = None
+# Replaces every comment of the tracks
+COMMENT = u'downloaded from themixtapesite.com'
+STRIP_ARGS = '-b:a 128k -map_metadata -1'
+PREVIEW_SECONDS = 30
+PREVIEW_ARGS = '-t %d -acodec copy' % PREVIEW_SECONDS
+ENCODING_PARAMS = '%s;%s' % (STRIP_ARGS, PREVIEW_ARGS)
+setup_lock = threading.Lock()
+# Where the external commands are, unless overridden by binaries in the settings
+BINARIES = {
+    'ffmpeg': '/root/bin/ffmpeg',
+    'processid3': '/export/getID3/processid3.php',
+    'youtube-upload': 'youtube-upload',
+}
 
 
 class Connection:
@@ -33,38 +63,50 @@ class Connection:
     url_base = 'http://themixtapesite.com/wp-content/uploads/gravity_forms/1-9e5dc27086c8b2fd2e48678e1f54f98c/2013/02/mixtape2/'
     s3_path = '/export/s3-mixtape2/'
 
+    def __init__(self, count=None):
+        """
+        count is the mixtape number to upload to, if one was already
+        reserved; a new one is allocated otherwise
+        """
+        self.count = count
+
     def __enter__(self):
         """
         Connects to S3 server, establishes connection number
         """
         debug('Setting up connection')
-        script_path = os.path.dirname(__file__)
-        # Gets the directory in which our script is located, empty if the
-        # working directory is the same
-        if not script_path:
-            script_path = "."
-        # We want to get the mixtape counter located in the same directory as
-        # the script, not the mixtape counter located in the working directory,
-        # as those may not be the same
-        counter_file = os.path.join(ROOT_DIR, 'mixtapes.counter')
-        self.counter = open(counter_file, 'r+')
-        # Open for writing and reading
-        self.count = str(1 + int(self.counter.read()))
-        debug("Mixtape counter incremented to %s, making dir" % self.count)
-        self.s3_path += self.count
+        # The counter lives in ROOT_DIR, and is allocated from atomically so
+        # that mixtapes processed at the same time never share a number
+        if self.count is None:
+            self.count = get_counter().allocate()
+        self.count = str(self.count)
+        debug("Mixtape number is %s, making dir" % self.count)
+        self.s3_path = os.path.join(
+            config.get('uploads', {}).get('s3_path') or self.s3_path, self.count
+        )
         if not os.path.exists(self.s3_path):
             os.makedirs(self.s3_path)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.throughput = {}
         return self
 
-    def upload(self, fname, local_dir=".", remote_dir=None):
+    def upload(self, fname, local_dir=".", remote_dir=None, remove=False):
         """
         Uploads fname from local_dir to remote_dir
         Trailing slash optional
+        The copy runs in the background on the upload stage, the returned
+        Task can be waited on. Every upload is waited on in __exit__ anyway
+        If remove is true, the local file is deleted once its copy is verified
         """
         if remote_dir:
             remote_path = os.path.join(self.s3_path, remote_dir)
-            if not os.path.exists(remote_path):
+            try:
                 os.makedirs(remote_path)
+            except OSError as exc:
+                # Several tracks may be uploading into the same remote dir
+                if exc.errno != errno.EEXIST:
+                    raise
         else:
             remote_dir = "."
 
@@ -74,44 +116,177 @@ class Connection:
             remote_dir
         ))
 
-        shutil.copy(
-            src=os.path.join(local_dir, fname),
-            dst=os.path.join(self.s3_path, remote_dir, fname)
+        src = os.path.join(local_dir, fname)
+        dst = os.path.join(self.s3_path, remote_dir, fname)
+        result = get_stage('upload', IO).submit(
+            self.copy, src, dst, remote_dir, remove
         )
+        with self.lock:
+            self.pending.append((src, dst, result))
+        return result
+
+    def copy(self, src, dst, destination, remove=False):
+        """
+        Copies src to dst and checks the copy is as large as src, raising
+        IOError if it isn't. Deletes src afterwards if remove is true
+        """
+        start = time.time()
+        try:
+            with timed('upload'):
+                size = copy_file(
+                    src, dst, fsync=config.get('uploads', {}).get('fsync', False)
+                )
+                copied = os.path.getsize(dst)
+                if copied != size:
+                    raise IOError("%s is %d bytes, expected %d" % (dst, copied, size))
+        except Exception:
+            # Never leave a partial copy where it could pass for the real one
+            if os.path.exists(dst):
+                os.remove(dst)
+            raise
+        elapsed = time.time() - start
+        if remove:
+            os.remove(src)
+        metrics.bytes_total.inc(size, stage='upload', destination=destination)
+        with self.lock:
+            total_size, total_time = self.throughput.get(destination, (0, 0))
+            self.throughput[destination] = (total_size + size, total_time + elapsed)
+        return size
+
+    def verify(self):
+        """
+        Waits for every upload, and returns those that failed or whose copy
+        doesn't match the local file
+        """
+        failed = []
+        for src, dst, result in self.pending:
+            try:
+                result.get()
+            except (IOError, OSError) as exc:
+                debug('Upload of "%s" failed: %s' % (src, exc))
+                failed.append(src)
+        for destination, (size, elapsed) in sorted(self.throughput.items()):
+            debug('Uploaded %.1fMB to "%s" at %.1fMB/s per copy' % (
+                size / 1048576.0, destination, size / 1048576.0 / max(elapsed, 0.001)
+            ))
+        return failed
 
     def __exit__(self, type, value, traceback):
         """
-        Notifies of errors, updates counter
+        Notifies of errors, waits for uploads to finish and verifies them,
+        sets the URL of what we've uploaded
         """
         if type or value or traceback:
             debug("There has been an error!")
         debug('Closing connection')
+        failed = self.verify()
         self.url = self.url_base + self.count + '/'
         # Where to find what we've been uploading
-        self.counter.seek(0)
-        self.counter.write(self.count)
-        self.counter.close()
+        if failed and type is None:
+            raise IOError("%d uploads failed: %s" % (len(failed), ', '.join(failed)))
+
+
+def copy_file(src, dst, fsync=False, buffer_size=1024 * 1024):
+    """
+    Copies src to dst and its permissions, returns the number of bytes copied
+    The data is moved by the kernel with sendfile where Python has it (3.3+),
+    falling back to a buffered copy
+    """
+    with open(src, 'rb') as source:
+        with open(dst, 'wb') as target:
+            size = os.fstat(source.fileno()).st_size
+            sendfile = getattr(os, 'sendfile', None)
+            offset = 0
+            try:
+                while sendfile and offset < size:
+                    sent = sendfile(target.fileno(), source.fileno(), offset,
+                                    size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as exc:
+                if exc.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+            if offset < size:
+                source.seek(offset)
+                target.seek(offset)
+                shutil.copyfileobj(source, target, buffer_size)
+            if fsync:
+                target.flush()
+                os.fsync(target.fileno())
+    shutil.copymode(src, dst)
+    return size
+
+
+def get_process_runner():
+    """
+    Returns the runner scheduling external commands on the reactor, allowing
+    processes.max_concurrent of them at once
+    """
+    global process_runner
+    with setup_lock:
+        if process_runner is None:
+            # Only needed with a reactor, and twisted is slow to import
+            from procrun import ProcessRunner
+            options = config.get('processes', {})
+            process_runner = ProcessRunner(
+                reactor,
+                max_concurrent=options.get('max_concurrent', 16),
+                timeout=options.get('timeout', 3600),
+                max_stderr=options.get('max_stderr', 64 * 1024)
+            )
+    return process_runner
 
 
 def execute_external_call(cmd_string):
     """
     Execute external system call
+    The command is killed once it runs longer than processes.timeouts for its
+    executable (processes.timeout by default)
     """
     debug('Executing: ' + cmd_string)
     cmd = shlex.split(cmd_string)
+    command = os.path.basename(cmd[0])
+    options = config.get('processes', {})
+    timeout = options.get('timeouts', {}).get(command, options.get('timeout', 3600))
 
     try:
-        return_code = blockingCallFromThread(reactor, getProcessValue, cmd[0], cmd[1:])
+        if reactor is None:
+            # Run from the command line, there is no reactor to wait on
+            result = run_blocking(cmd, timeout, options.get('max_stderr', 64 * 1024))
+        else:
+            from twisted.internet.threads import blockingCallFromThread
+            result = blockingCallFromThread(
+                reactor, get_process_runner().run, cmd, timeout
+            )
     except Exception as exc:
         debug("Caught exception executing call: %s" % exc)
+        metrics.processes_total.inc(command=command, result='error')
         return False
 
-    if return_code != 0:
-        debug("Warning: FFMpeg returned nonzero code: %d" % return_code)
+    metrics.process_seconds.observe(result.duration, command=command)
+    if result.cpu_time is not None:
+        metrics.process_cpu_seconds_total.inc(result.cpu_time, command=command)
+    if not result.ok:
+        debug("Warning: %s" % result.describe())
+        if result.stderr:
+            debug(result.stderr.decode('utf-8', 'replace'))
+        metrics.processes_total.inc(
+            command=command, result='timeout' if result.timed_out else 'failed'
+        )
         return False
+    debug(result.describe())
+    metrics.processes_total.inc(command=command, result='ok')
     return True
 
 
+def binary(name):
+    """
+    Returns the path of the external command name, quoted for a command line
+    """
+    return pipes.quote(config.get('binaries', {}).get(name) or BINARIES[name])
+
+
 def generate_strip(full_path, target_path):
     '''
     Takes the file located at full_path, removes 1D3 tags and rencodes at
@@ -119,7 +294,8 @@ def generate_strip(full_path, target_path):
     '''
     debug('Stripping "%s" to "%s"' % (full_path, target_path))
 
-    cmd_string = '/root/bin/ffmpeg -i "%s" -b:a 128k -loglevel error -map_metadata -1 -map 0:a "%s"' % (
+    cmd_string = '%s -i "%s" -b:a 128k -loglevel error -map_metadata -1 -map 0:a "%s"' % (
+        binary('ffmpeg'),
         full_path,
         target_path
     )
@@ -127,13 +303,52 @@ def generate_strip(full_path, target_path):
     return execute_external_call(cmd_string)
 
 
+def get_preview_method():
+    """
+    How previews are made: "native" (the default) slices them out of the
+    track with mp3slice, "ffmpeg" copies them with ffmpeg
+    """
+    return config.get('processing', {}).get('preview_method', 'native')
+
+
+def output_params():
+    """
+    Everything besides the track itself that its outputs depend on: the
+    encoding parameters, how the preview is made and the filter list its
+    tags were cleaned with
+    """
+    return ENCODING_PARAMS, get_preview_method(), str(filter_engine.signature)
+
+
+def slice_preview(full_path, target_path):
+    """
+    Slices the first 30 seconds of frames of full_path into target_path,
+    without starting ffmpeg, if the preview method is native
+    Returns whether it did, ffmpeg has to make the preview otherwise
+    """
+    if get_preview_method() != 'native':
+        return False
+    debug('Slicing preview "%s" to "%s"' % (full_path, target_path))
+    try:
+        with timed('preview_slice'):
+            mp3slice.slice_file(full_path, target_path, PREVIEW_SECONDS)
+        return True
+    except (ValueError, IOError, OSError) as exc:
+        debug('Unable to slice "%s", falling back to ffmpeg: %s' % (full_path, exc))
+        return False
+
+
 def generate_preview(full_path, target_path):
     """
     Generates 30 second preview mp3
     """
+    if slice_preview(full_path, target_path):
+        return True
     debug('Creating preview "%s" to "%s"' % (full_path, target_path))
 
-    cmd_string = '/root/bin/ffmpeg -t 30 -loglevel error -i "%s" -acodec copy "%s"' % (
+    cmd_string = '%s -t %d -loglevel error -i "%s" -acodec copy "%s"' % (
+        binary('ffmpeg'),
+        PREVIEW_SECONDS,
         full_path,
         target_path
     )
@@ -141,6 +356,35 @@ def generate_preview(full_path, target_path):
     return execute_external_call(cmd_string)
 
 
+def generate_outputs(full_path, strip_path, preview_path):
+    """
+    Generates the 128kbps strip and, unless preview_path is None, the 30
+    second preview from a single ffmpeg run over full_path
+    Returns whether each of (strip, preview) was written
+    """
+    debug('Creating strip "%s" and preview "%s" from "%s"' % (
+        strip_path,
+        preview_path,
+        full_path
+    ))
+
+    outputs = ['-map 0:a %s "%s"' % (STRIP_ARGS, strip_path)]
+    if preview_path:
+        outputs.append('-map 0:a %s "%s"' % (PREVIEW_ARGS, preview_path))
+
+    cmd_string = '%s -loglevel error -i "%s" %s' % (
+        binary('ffmpeg'), full_path, ' '.join(outputs)
+    )
+
+    if not execute_external_call(cmd_string):
+        return False, False
+    written = [
+        path is not None and os.path.exists(path) and os.path.getsize(path) > 0
+        for path in (strip_path, preview_path)
+    ]
+    return tuple(written)
+
+
 def generate_video(full_path, target_path, image_path=None):
     """
     Generates video to be uploaded to youtube
@@ -148,13 +392,18 @@ def generate_video(full_path, target_path, image_path=None):
     debug('Creating video from "%s" to "%s"' % (full_path, target_path))
 
     if image_path:
-        cmd_string = 'ffmpeg -loglevel error -loop 1 -i "%s" -i "%s" -c:v libx264 -c:a aac -strict experimental -b:a 128k -shortest "%s"' % (
+        # A single still repeated at 1 frame per second encodes in a fraction
+        # of the time full motion would take
+        cmd_string = '%s -loglevel error -loop 1 -framerate 1 -i "%s" -i "%s" -c:v libx264 -tune stillimage -preset %s -pix_fmt yuv420p -r 1 -c:a aac -strict experimental -b:a 128k -shortest "%s"' % (
+            binary('ffmpeg'),
             image_path,
             full_path,
+            config.get('youtube', {}).get('preset', 'veryfast'),
             target_path
         )
     else:
-        cmd_string = 'ffmpeg -loglevel error -i "%s" -c:v libx264 -c:a aac -strict experimental -b:a 128k -shortest "%s"' % (
+        cmd_string = '%s -loglevel error -i "%s" -c:v libx264 -c:a aac -strict experimental -b:a 128k -shortest "%s"' % (
+            binary('ffmpeg'),
             full_path,
             target_path
         )
@@ -168,12 +417,19 @@ def upload_youtube(full_path, email, password, title, description):
     """
     debug('Uploading video to youtube: %s' % full_path)
 
-    cmd_string = 'youtube-upload --email=%s --password=%s --title=%s --description=%s --category="Music" --keywords="themixtapesite.com" %s' % (
-        pipes.quote(email),
-        pipes.quote(password),
-        pipes.quote(title.encode('utf-8')),
-        pipes.quote(description.encode('utf-8')),
-        pipes.quote(full_path)
+    # Settings and tags come as unicode, which can't be mixed with the UTF-8
+    # encoded title in one command line
+    args = [
+        value.encode('utf-8') if not isinstance(value, str) else value
+        for value in (email, password, title, description, full_path)
+    ]
+    cmd_string = '%s --email=%s --password=%s --title=%s --description=%s --category="Music" --keywords="themixtapesite.com" %s' % (
+        binary('youtube-upload').encode('utf-8'),
+        pipes.quote(args[0]),
+        pipes.quote(args[1]),
+        pipes.quote(args[2]),
+        pipes.quote(args[3]),
+        pipes.quote(args[4])
     )
 
     return execute_external_call(cmd_string)
@@ -183,11 +439,30 @@ def pre_cache_mp3_id3(file_path):
     """
     call external php script to cache mp3 id3 tag info to database
     """
-    cmd_string = '/export/getID3/processid3.php %s' % file_path
+    cmd_string = '%s %s' % (binary('processid3'), file_path)
 
     return execute_external_call(cmd_string)
 
 
+def read_tags(audiofile):
+    """
+    Returns the artist, title, album, duration in seconds and bitrate in kbps
+    of a loaded eyed3 file
+    """
+    tags = dict.fromkeys(('artist', 'title', 'album', 'duration', 'bitrate'))
+    if audiofile is None:
+        return tags
+    if audiofile.tag is not None:
+        tags['artist'] = audiofile.tag.artist
+        tags['title'] = audiofile.tag.title
+        tags['album'] = audiofile.tag.album
+    if audiofile.info is not None:
+        tags['duration'] = audiofile.info.time_secs
+        # eyed3 gives (whether it is VBR, bitrate)
+        tags['bitrate'] = audiofile.info.bit_rate[1]
+    return tags
+
+
 def get_images(directory):
     """ return the full paths to all the image files in a given directory """
     images = []
@@ -195,21 +470,43 @@ def get_images(directory):
     return images
 
 
+def load_audiofile(path):
+    """
+    Parses the MP3 at path with eyed3, which is only imported once needed as
+    it is slow to import
+    """
+    import eyed3
+    return eyed3.load(path)
+
+
 def clean_mp3_id3_tags(audiofile):
-    """ remove any ID3 tags that we don't like """
-    filter_list = get_filter_list()
+    """
+    remove any ID3 tags that we don't like
+    The tag is only saved when cleaning changes it, in its own version, so
+    eyed3 writes it in place over the old tag and its padding, and only
+    rewrites the audio when the new tag doesn't fit
+    Returns audiofile, and whether the file was changed
+    """
+    changed = False
     try:
-        audiofile.tag.artist = filter_string(audiofile.tag.artist, filter_list)
-        audiofile.tag.title = filter_string(audiofile.tag.title, filter_list)
-        audiofile.tag.album = filter_string(audiofile.tag.album, filter_list)
-        for comment in audiofile.tag.comments:
-            comment.text = u'downloaded from themixtapesite.com'
-            comment.data = u'downloaded from themixtapesite.com'
-        audiofile.tag.save()
+        tag = audiofile.tag
+        for field in ('artist', 'title', 'album'):
+            value = getattr(tag, field)
+            cleaned = filter_engine.filter(value)
+            if cleaned != value:
+                setattr(tag, field, cleaned)
+                changed = True
+        for comment in tag.comments:
+            if comment.text != COMMENT:
+                comment.text = COMMENT
+                comment.data = COMMENT
+                changed = True
+        if changed:
+            tag.save(version=tag.version)
     except Exception as exc:
         debug('Caught exception trying to clean id3 tags for "%s"' % audiofile)
         debug('Exception: %s' % exc)
-    return audiofile
+    return audiofile, changed
 
 
 def zip_folder(folder, name=None):
@@ -232,6 +529,84 @@ def zip_folder(folder, name=None):
     return name
 
 
+def extract_member(archive, name, path, buffer_size=None, digest=None):
+    """
+    Streams the member name (or ZipInfo) of archive to path in chunks of buffer_size bytes
+    (processing.extract_buffer_size, 1MB by default), so that memory use does
+    not depend on the size of the member
+    If digest is given (a hashlib object), it is updated with every chunk
+    """
+    if buffer_size is None:
+        buffer_size = config.get('processing', {}).get(
+            'extract_buffer_size', 1024 * 1024
+        )
+    source = archive.open(name)
+    try:
+        with open(path, 'wb') as target:
+            for chunk in iter(lambda: source.read(buffer_size), b''):
+                if digest is not None:
+                    digest.update(chunk)
+                target.write(chunk)
+    finally:
+        source.close()
+
+
+def copy_zip_member(source, zinfo, target, arcname=None):
+    """
+    Copies the still compressed member zinfo of the ZipFile source into the
+    ZipFile target as arcname, without decompressing or recompressing it
+    """
+    entry = copy.copy(zinfo)
+    if arcname is not None:
+        entry.filename = arcname
+    # Sizes are known up front, so there is no data descriptor to write and
+    # any old ZIP64 extra field will be regenerated by FileHeader
+    entry.flag_bits &= ~0x08
+    entry.extra = b''
+    with open(source.filename, 'rb') as src:
+        src.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               src.read(zipfile.sizeFileHeader))
+        src.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                 header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        target._writecheck(entry)
+        target._didModify = True
+        entry.header_offset = target.fp.tell()
+        target.fp.write(entry.FileHeader())
+        remaining = zinfo.compress_size
+        while remaining:
+            chunk = src.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipfile('Truncated member "%s"' % zinfo.filename)
+            target.fp.write(chunk)
+            remaining -= len(chunk)
+    if hasattr(target, 'start_dir'):
+        target.start_dir = target.fp.tell()
+    target.filelist.append(entry)
+    target.NameToInfo[entry.filename] = entry
+
+
+def build_archive(folder, name, source=None, unchanged=None):
+    """
+    Builds the ZIP name out of every file in folder without compressing it.
+    Files listed in unchanged (a dict of base names to ZipInfos of source) are
+    copied from the original upload as they are
+    """
+    unchanged = unchanged or {}
+    debug('Archiving "%s" to "%s"' % (folder, name))
+    zipped = zipfile.ZipFile(name, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    try:
+        for fname in glob.glob(os.path.join(folder, '*')):
+            arcname = os.path.basename(fname)
+            if arcname in unchanged:
+                copy_zip_member(source, unchanged[arcname], zipped, arcname)
+            else:
+                zipped.write(fname, arcname, zipfile.ZIP_STORED)
+    finally:
+        zipped.close()
+    return name
+
+
 def clear_dir(path="data"):
     """
     Removes every file that doesn't end with .ZIP at path
@@ -242,120 +617,320 @@ def clear_dir(path="data"):
             os.remove(os.path.join(path, fname))
 
 
-def process_zip(zip_path, keep_dirs=True, keep_orig=False, save_rest=True):
+def get_track_cache():
+    """
+    Returns the cache of transcoded tracks, or None if cache.enabled is off
+    It lives in cache.dir (ROOT_DIR/cache by default) and holds at most
+    cache.max_size_mb megabytes
+    """
+    global track_cache
+    options = config.get('cache', {})
+    if not options.get('enabled'):
+        return None
+    with setup_lock:
+        if track_cache is None:
+            track_cache = TrackCache(
+                options.get('dir') or os.path.join(ROOT_DIR, 'cache'),
+                max_size=options.get('max_size_mb', 10240) * 1024 * 1024
+            )
+    return track_cache
+
+
+def process_track(conn, name, full_dir, strip_dir, preview_dir,
+                  image_path=None, source_hash=None, keep_files=True):
+    """
+    Cleans, strips, previews and uploads a single track
+    source_hash is the hash of the track as extracted, which its outputs are
+    cached under; without it the cache isn't used
+    If processing.preview_video is set, the preview and image_path are
+    queued to be made into a video for YouTube in the background
+    Unless keep_files is true, the strip and preview of the track are deleted
+    as soon as they have been uploaded. The full track is left for the archive
+    Returns whether every step succeeded and whether cleaning changed the
+    file
+    """
+    local_start_time = time.time()
+    debug('Processing "%s"' % name)
+    success = True
+    full_path = os.path.join(full_dir, name)
+    stripped_path = os.path.join(strip_dir, name)
+    preview_path = os.path.join(preview_dir, name)
+    with timed('tag_clean'):
+        audiofile, changed = clean_mp3_id3_tags(load_audiofile(full_path))
+    cache = source_hash and get_track_cache()
+    outputs = {'strip': stripped_path, 'preview': preview_path}
+    # Strip and preview come out of a single ffmpeg run, so they are timed
+    # together as the transcode stage. The preview is sliced out natively
+    # beforehand where possible, leaving ffmpeg only the strip
+    with timed('transcode'):
+        if cache:
+            # What ffmpeg is given only depends on the extracted track and on
+            # the filter list its tags were cleaned with
+            key = cache.key(source_hash, *output_params())
+        if cache and cache.fetch(key, outputs):
+            strip_ok = preview_ok = True
+        else:
+            sliced = slice_preview(full_path, preview_path)
+            strip_ok, preview_ok = generate_outputs(
+                full_path,
+                strip_path=stripped_path,
+                preview_path=None if sliced else preview_path
+            )
+            preview_ok = preview_ok or sliced
+            if cache and strip_ok and preview_ok:
+                cache.store(key, outputs)
+    if strip_ok:
+        conn.upload(name, local_dir=full_dir)
+        conn.upload(name, local_dir=strip_dir, remote_dir="128/",
+                    remove=not keep_files)
+    else:
+        debug("Not uploading because stripping apparently failed")
+        success = False
+    if preview_ok:
+        if config.get('processing', {}).get('preview_video'):
+            # Before the upload can delete the preview
+            queue_video(conn.count, name, preview_path, image_path,
+                        read_tags(audiofile))
+        conn.upload(name, local_dir=preview_dir, remote_dir="preview/",
+                    remove=not keep_files)
+    else:
+        debug("Unable to generate preview file")
+        success = False
+    elapsed = time.time() - local_start_time
+    metrics.stage_seconds.observe(elapsed, stage='total', scope='track')
+    metrics.tracks_total.inc(result='ok' if success else 'failed')
+    debug('Finished processing "%s" in %.2fs' % (name, elapsed))
+    return success, changed
+
+
+def queue_video(count, name, preview_path, image_path, tags):
+    """
+    Hands the preview of a track to the YouTube lane, which makes and uploads
+    its video later. A failure to queue it never fails the track
+    """
+    title = tags['title'] or os.path.splitext(name)[0]
+    try:
+        get_video_lane().enqueue(
+            '%s/%s' % (count, name), preview_path, image_path, title,
+            '%s - %s' % (tags['artist'] or '', title)
+        )
+    except Exception as exc:
+        debug('Unable to queue the video of "%s": %s' % (name, exc))
+
+
+def clean_track(full_path):
+    """
+    Only cleans the tags of a track whose other outputs are reused
+    Returns (True, whether cleaning changed the file)
+    """
+    with timed('tag_clean'):
+        audiofile, changed = clean_mp3_id3_tags(load_audiofile(full_path))
+    return True, changed
+
+
+def process_zip(zip_path, keep_dirs=True, keep_orig=False, save_rest=True,
+                progress=None, count=None, post_id=None):
     """
     Upload, Rencode, Reupload each MP3 in zip_path
     Upload ZIP of all rencoded files
     If keep_dirs is true, temporary files for unzip are not deleted
-    If remove_orig is true, the original ZIP will be deleted
+    Unless keep_orig is true, the original ZIP is deleted once it has been
+    processed successfully
+    If progress is given, it is called with a short description of how far
+    along the job is
+    If count is given, it is the already reserved mixtape number to upload to
+    If post_id is given and the post was published before, its mixtape
+    number is reused and only new or changed tracks are processed again
     """
+    if progress is None:
+        progress = lambda status: None
+    manifest = None
+    # Outputs made with other parameters or filters are never reused
+    params = ';'.join(output_params())
+    if post_id is not None:
+        manifest = Manifest.load(post_id)
+        if manifest and count is None:
+            debug("Post %s was published before, as mixtape %s" % (
+                post_id, manifest.count
+            ))
+            count = manifest.count
     debug("ZIP path: %s\n\
            Keep temporary files: %s\n\
            Keep original ZIP: %s\n\
            Save non-ZIP files: %s" % (zip_path, keep_dirs, keep_orig, save_rest))
     debug("Loading ZIP file for reading")
+    original = os.stat(zip_path)
     mixtape = zipfile.ZipFile(zip_path, 'r')
     zipped_name = None
+    extracted = {}
 
-    BASE_PATH = os.path.join(ROOT_DIR, 'output')
-    FULL_DIR = os.path.join(BASE_PATH, 'full')
-    STRIP_DIR = os.path.join(BASE_PATH, 'stripped')
-    PREVIEW_DIR = os.path.join(BASE_PATH, 'preview')
-    VIDEO_DIR = os.path.join(BASE_PATH, 'video')
-    IMAGE_DIR = os.path.join(BASE_PATH, 'images')
-    debug('Making temp folders')
-    WORKING_DIRS = [FULL_DIR, STRIP_DIR, PREVIEW_DIR, VIDEO_DIR, IMAGE_DIR]
-    for wdir in WORKING_DIRS:
-        if not os.path.exists(wdir):
-            os.mkdir(wdir)
+    OUTPUT_DIR = os.path.join(ROOT_DIR, 'output')
+    try:
+        os.mkdir(OUTPUT_DIR)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    # Wait for enough disk space for everything the job will write: the
+    # tracks, the archive too if it's built locally, and the images
+    deflate = config.get('processing', {}).get('archive_mode') == 'deflate'
+    workspace = get_workspace()
+    footprint = workspace.estimate(mixtape.infolist(), copies=2 if deflate else 1)
+    waited = workspace.admit(footprint, os.path.basename(zip_path))
+    metrics.stage_seconds.observe(waited, stage='workspace_wait', scope='mixtape')
+    BASE_PATH = None
     try:
-        # Extract each file in the ZIP that ends with mp3 to the full folder
-        # and then the stripped folder. If an error is raised, the folders we
-        # just just created will be removed ina the finally block of this try.
+        # Every job gets its own working directory, so that mixtapes processed
+        # at the same time never overwrite each other's files
+        BASE_PATH = tempfile.mkdtemp(prefix='job-', dir=OUTPUT_DIR)
+        FULL_DIR = os.path.join(BASE_PATH, 'full')
+        STRIP_DIR = os.path.join(BASE_PATH, 'stripped')
+        PREVIEW_DIR = os.path.join(BASE_PATH, 'preview')
+        IMAGE_DIR = os.path.join(BASE_PATH, 'images')
+        debug('Making temp folders in "%s"' % BASE_PATH)
+        WORKING_DIRS = [FULL_DIR, STRIP_DIR, PREVIEW_DIR, IMAGE_DIR]
+        for wdir in WORKING_DIRS:
+            os.mkdir(wdir)
+        # Pick the MP3s and images of the ZIP. If an error is raised, the
+        # folders we just created will be removed in the finally block of
+        # this try
+        tracks = {}
+        progress('extracting')
+        start = time.time()
         for name in mixtape.namelist():
-            if "MACOSX" not in name:
-                if name.lower().endswith('mp3'):
-                    basename = os.path.basename(name)
-                    if not basename.startswith("."):
-                        path = os.path.join(FULL_DIR, basename)
-                        debug('Extracting "%s" to "%s"' % (name, path))
-                        data = mixtape.read(name)
-                        f = open(path, 'w')
-                        f.write(data)
-                        f.close()
-                elif name.lower().endswith('jpg'):
-                    basename = os.path.basename(name)
-                    if not basename.startswith("."):
-                        path = os.path.join(IMAGE_DIR, basename)
-                        debug('Extracting image "%s" to "%s"' % (name, path))
-                        data = mixtape.read(name)
-                        f = open(path, 'w')
-                        f.write(data)
-                        f.close()
-        timing.log("Finished extracting", timing.clock() - timing.start)
-        # Upload all of the files, stripping copies into the stripped folder
-        with Connection() as conn:
+            basename = os.path.basename(name)
+            if "MACOSX" in name or basename.startswith("."):
+                continue
+            if name.lower().endswith('mp3'):
+                # A later member with the same name replaces an earlier one
+                tracks[basename] = mixtape.getinfo(name)
+            elif name.lower().endswith('jpg'):
+                path = os.path.join(IMAGE_DIR, basename)
+                debug('Extracting image "%s" to "%s"' % (name, path))
+                extract_member(mixtape, name, path)
+        extract_time = time.time() - start
+        # Extract each track to the full folder and hand it straight to the
+        # transcode stage, which blocks us while its queue is full, so we
+        # never get more than that many tracks ahead of it on disk
+        with Connection(count) as conn:
             images = get_images(IMAGE_DIR)
-            for name in os.listdir(FULL_DIR):
-                local_start_time = timing.clock()
-                debug('Processing "%s"' % name)
-                full_path = os.path.join(FULL_DIR, name)
-                stripped_path = os.path.join(STRIP_DIR, name)
-                preview_path = os.path.join(PREVIEW_DIR, name)
-                audiofile = eyed3.load(full_path)
-                audiofile = clean_mp3_id3_tags(audiofile)
-                if generate_strip(full_path, target_path=stripped_path):
-                    conn.upload(name, local_dir=FULL_DIR)
-                    conn.upload(name, local_dir=STRIP_DIR, remote_dir="128/")
-                else:
-                    debug("Not uploading because stripping apparently failed")
-                if generate_preview(full_path, target_path=preview_path):
-                    conn.upload(name, local_dir=PREVIEW_DIR, remote_dir="preview/")
-                    video_path = os.path.join(VIDEO_DIR, name)
-                    video_path = video_path.replace('mp3', 'mp4')
-                    if images:
-                        vid_args = {
-                            'full_path': preview_path,
-                            'target_path': video_path,
-                            'image_path': images.pop()
-                        }
+            stage = get_stage('transcode', CPU)
+            tracks_start = time.time()
+            results = []
+            # Largest tracks first, so that the stage doesn't end up waiting
+            # on one long track started last
+            names = sorted(
+                tracks, key=lambda name: tracks[name].file_size, reverse=True
+            )
+            try:
+                for index, name in enumerate(names):
+                    zinfo = tracks[name]
+                    path = os.path.join(FULL_DIR, name)
+                    debug('Extracting "%s" to "%s"' % (zinfo.filename, path))
+                    start = time.time()
+                    digest = hashlib.sha1()
+                    extract_member(mixtape, zinfo, path, digest=digest)
+                    extracted[name] = (zinfo, digest.hexdigest())
+                    extract_time += time.time() - start
+                    # Every video gets a still, the covers taking turns
+                    image_path = images[index % len(images)] if images else None
+                    if manifest and manifest.reusable(
+                            name, zinfo, params, conn.s3_path):
+                        debug('"%s" is unchanged, keeping its outputs' % name)
+                        results.append((name, stage.submit(clean_track, path)))
+                        continue
+                    results.append((name, stage.submit(
+                        process_track, conn, name, FULL_DIR, STRIP_DIR,
+                        PREVIEW_DIR, image_path, extracted[name][1],
+                        keep_dirs
+                    )))
+            except Exception:
+                # The tracks already submitted still use the working dirs
+                for name, result in results:
+                    result.wait()
+                raise
+            debug("Finished extracting")
+            metrics.stage_seconds.observe(
+                extract_time, stage='extract', scope='mixtape'
+            )
+            succeeded = set()
+            changed = {}
+            for done, (name, result) in enumerate(results):
+                progress('%d/%d tracks' % (done, len(results)))
+                try:
+                    ok, changed[name] = result.get()
+                    if ok:
+                        succeeded.add(name)
                     else:
-                        vid_args = {
-                            'full_path': preview_path,
-                            'target_path': video_path
-                        }
-                    # if generate_video(**vid_args):
-                    #     ## upload to youtube
-                    #     upload_youtube(
-                    #         video_path,
-                    #         config['youtube']['user'],
-                    #         config['youtube']['password'],
-                    #         audiofile.tag.title,
-                    #         '%s - %s' % (audiofile.tag.artist, audiofile.tag.title)
-                    #     )
-                    # else:
-                    #     debug("Unable to generate video file")
+                        debug('Track "%s" was not fully processed' % name)
+                except Exception as exc:
+                    # One bad track must not take the whole mixtape down
+                    debug('Caught exception processing "%s": %s' % (name, exc))
+                    metrics.tracks_total.inc(result='error')
+            metrics.stage_seconds.observe(
+                time.time() - tracks_start, stage='tracks', scope='mixtape'
+            )
+            progress('%d/%d tracks' % (len(results), len(results)))
+            for line in pipeline.describe():
+                debug(line)
+            with timed('id3_precache', scope='mixtape'):
+                ## Call php script to pre-cache mp3 info
+                debug("calling pre_cache php script: processid3.php")
+                pre_cache_mp3_id3(conn.s3_path)
+            zipped_name = os.path.basename(zip_path)
+            if not zipped_name.endswith(".zip"):
+                zipped_name += '.zip'
+            progress('archiving')
+            with timed('zip', scope='mixtape'):
+                if deflate:
+                    ## generate zip archive, upload, and delete local copy
+                    zipped_path = zip_folder(
+                        FULL_DIR, name=os.path.join(BASE_PATH, zipped_name)
+                    )
+                    conn.upload(zipped_name, local_dir=BASE_PATH).get()
+                    os.remove(zipped_path)
                 else:
-                    debug("Unable to generate preview file")
-                timing.log(
-                    "Finished processing \"%s\"" % name, timing.clock() - local_start_time
-                )
-            ## Call php script to pre-cache mp3 info
-            debug("calling pre_cache php script: processid3.php")
-            pre_cache_mp3_id3(conn.s3_path)
-            ## generate zip archive, upload, and delete local copy
-            zipped_name = zip_folder(FULL_DIR, name=os.path.basename(zip_path))
-            conn.upload(zipped_name)
-            os.remove(zipped_name)
+                    ## write the archive straight to S3, reusing the compressed
+                    ## data of every track whose tags were left untouched
+                    unchanged = dict(
+                        (name, extracted[name][0]) for name in changed
+                        if not changed[name]
+                    )
+                    build_archive(
+                        FULL_DIR,
+                        name=os.path.join(conn.s3_path, zipped_name),
+                        source=mixtape,
+                        unchanged=unchanged
+                    )
+        # Only once every upload has been verified, when leaving the block
+        if post_id is not None:
+            # Tracks that failed are left out, to be processed next time
+            published = Manifest(post_id, conn.count, zipped_name, params)
+            for name in succeeded:
+                published.add_track(name, extracted[name][0], [
+                    name, os.path.join('128', name),
+                    os.path.join('preview', name)
+                ], conn.s3_path)
+            if manifest:
+                manifest.remove_stale(conn.s3_path, extracted, zipped_name)
+            published.save()
     finally:
         debug('Cleaning up')
-        if not keep_dirs:
-            for wdir in WORKING_DIRS:
-                shutil.rmtree(wdir)
-        if not keep_orig:
+        try:
+            if not keep_dirs and BASE_PATH:
+                shutil.rmtree(BASE_PATH)
+            if not save_rest:
+                clear_dir(os.path.join(ROOT_DIR, "data"))
+        finally:
+            workspace.release(footprint)
+    if not keep_orig:
+        # Only once processed, so that a job that failed can be retried, and
+        # only if it's still the ZIP we processed rather than a newer upload
+        # that its post was approved again for
+        current = os.stat(zip_path)
+        if (current.st_mtime, current.st_size) == (original.st_mtime, original.st_size):
             os.remove(zip_path)
-        if not save_rest:
-            clear_dir(os.path.join(ROOT_DIR, "data"))
+        else:
+            debug('Keeping "%s", it was replaced while processing' % zip_path)
     url = conn.url + zipped_name
     debug("ZIP processed")
     return url
@@ -363,21 +938,19 @@ def process_zip(zip_path, keep_dirs=True, keep_orig=False, save_rest=True):
 
 def get_mixtape_info(post_id):
     """
-    Makes an SQL query to get the path to the ZIP assosiated with post_id
+    Makes an SQL query to get the path to the ZIP assosiated with post_id, and
+    the title of the post
     """
     debug("Getting path")
-    db = MySQLdb.connect(**config['database'])
-    cur = db.cursor()
-    cur.execute('SELECT meta_value FROM tm1_postmeta WHERE post_id = %s AND meta_key = "file_url"' % post_id)
-    url = cur.fetchall()[0][0] # First row, first cell returned
+    rows = get_pool().query(
+        'SELECT m.meta_value, p.post_title FROM tm1_posts p '
+        'JOIN tm1_postmeta m ON m.post_id = p.ID '
+        'WHERE p.ID = %s AND m.meta_key = %s',
+        (post_id, 'file_url')
+    )
+    url, post_slug = rows[0] # First row returned
     debug("URL: %s" % url)
     path = os.path.join(ROOT_DIR, "data", os.path.basename(url))
-    cur.close()
-    cur = db.cursor()
-    cur.execute("SELECT post_title FROM tm1_posts WHERE ID = %s" % post_id)
-    post_slug = cur.fetchall()[0][0] # First row, first cell returned
-    cur.close()
-    db.commit()
     return path, post_slug
 
 
@@ -386,50 +959,227 @@ def publish_post(post_id, url, post_name):
     Mark post_id as published and processed, set ZIP URL
     """
     debug("Trying to publish post: id=%s url=%s" % (post_id, url))
-    count = 0
-    while 1:
-        debug("Try #%s" % count)
+
+    def publish(cur):
+        debug("Setting publish status")
+        cur.execute(
+            'UPDATE tm1_posts SET post_status = %s WHERE ID = %s',
+            ('publish', post_id)
+        )
+        debug("Setting ZIP URL")
+        cur.execute(
+            'UPDATE tm1_postmeta SET meta_value = %s WHERE post_id = %s AND meta_key = %s',
+            (url, post_id, 'file_url')
+        )
+        debug("Setting zipping_status to processed")
+        cur.execute(
+            'UPDATE tm1_postmeta SET meta_value = %s WHERE post_id = %s AND meta_key = %s',
+            ('processed', post_id, 'zipping_status')
+        )
+
+    # All three updates are committed together, or retried together
+    get_pool().run(publish)
+    debug("Post published: %s" % url)
+
+
+def write_metrics():
+    """
+    Writes the metrics to metrics.textfile, if set, for a scraper to collect
+    """
+    path = config.get('metrics', {}).get('textfile')
+    if path:
         try:
-            debug("Connecting to MySQL databse")
-            db = MySQLdb.connect(**config['database'])
-            cur = db.cursor()
-            debug("Setting publish status")
-            cur.execute(r'UPDATE tm1_posts SET post_status="publish" WHERE ID = %s;' % post_id)
-            debug("Setting ZIP URL")
-            cur.execute(r'UPDATE tm1_postmeta SET meta_value="%s" WHERE post_id = %s AND meta_key = "file_url";' % (url, post_id))
-            debug("Setting zipping_status to processed")
-            cur.execute(r'UPDATE tm1_postmeta SET meta_value="processed" WHERE post_id = %s AND meta_key = "zipping_status";' % post_id)
-            #debug('Reset post_name')
-            #cur.execute(r'UPDATE tm1_posts SET post_name="test-direct" WHERE ID = %s;' % post_id)
-            cur.close()
-            db.commit()
-            # Save our changes to the database
-            debug("Post published: %s" % url)
-            break
-        except MySQLdb.Error as e:
-            debug("MySQL error: %s; Trying again." % e.message)
-            count += 1
-
-
-def process_mixtape(ID):
+            metrics.registry.write(path)
+        except (IOError, OSError) as exc:
+            debug("Unable to write metrics to %s: %s" % (path, exc))
+
+
+def get_publisher():
+    """
+    Returns the publisher shared by every mixtape, which batches posts
+    finishing within publishing.window seconds, up to publishing.max_items,
+    and doesn't wait once every mixtape in flight has joined the batch
+    """
+    global publisher
+    with setup_lock:
+        if publisher is None:
+            options = config.get('publishing', {})
+            publisher = BatchPublisher(
+                publish_post,
+                window=options.get('window', 2.0),
+                max_items=options.get('max_items', 20)
+            )
+    return publisher
+
+
+def process_mixtape(ID, progress=None):
     """
     Process a mixtape identified by its post's ID
+    progress is passed on to process_zip
     """
-    zip_path, post_slug = get_mixtape_info(ID)
-    debug("Path for ZIP: %s" % zip_path)
-    debug("Mixtape slug: %s" % post_slug)
-    url = process_zip(zip_path, **args)
-    # The variable args is searched at the global scope
-    publish_post(int(ID), url, post_slug)
-    debug("Mixtape processed: %s" % url)
+    start = time.time()
+    publisher = get_publisher()
+    publisher.begin()
+    try:
+        zip_path, post_slug = get_mixtape_info(ID)
+        debug("Path for ZIP: %s" % zip_path)
+        debug("Mixtape slug: %s" % post_slug)
+        url = process_zip(zip_path, progress=progress, post_id=ID, **args)
+        # The variable args is searched at the global scope
+        if progress:
+            progress('publishing')
+        with timed('publish', scope='mixtape'):
+            publisher.publish(int(ID), url, post_slug)
+        debug("Mixtape processed: %s" % url)
+        metrics.mixtapes_total.inc(result='ok')
+    except Exception:
+        metrics.mixtapes_total.inc(result='failed')
+        raise
+    finally:
+        publisher.end()
+        metrics.stage_seconds.observe(
+            time.time() - start, stage='total', scope='mixtape'
+        )
+        write_metrics()
+
+
+def zip_size(zip_path):
+    """
+    Total uncompressed size of the MP3s in zip_path
+    """
+    archive = zipfile.ZipFile(zip_path, 'r')
+    try:
+        return sum(info.file_size for info in archive.infolist()
+                   if info.filename.lower().endswith('mp3'))
+    finally:
+        archive.close()
+
+
+def find_zips(paths, list_path=None):
+    """
+    Expands paths, and the lines of the file at list_path, into ZIP paths.
+    Directories stand for every ZIP directly inside them
+    """
+    paths = list(paths)
+    if list_path:
+        with open(list_path) as list_file:
+            paths.extend(line.strip() for line in list_file if line.strip())
+    zips = []
+    for path in paths:
+        if os.path.isdir(path):
+            zips.extend(sorted(
+                os.path.join(path, fname) for fname in os.listdir(path)
+                if fname.lower().endswith('.zip')
+            ))
+        else:
+            zips.append(path)
+    return zips
+
+
+def process_batch(zip_paths, jobs=None, journal=None, restart=False, **kwargs):
+    """
+    Processes many ZIPs in one go. Up to jobs ZIPs (processing.
+    concurrent_mixtapes by default) are processed at once, largest first,
+    and all of their tracks share the pipeline stages. Every finished ZIP is
+    appended to the journal (ROOT_DIR/batch.journal by default), and skipped
+    when the batch is run again, unless restart is set
+    kwargs are passed on to process_zip
+    """
+    if journal is None:
+        journal = os.path.join(ROOT_DIR, 'batch.journal')
+    if restart and os.path.exists(journal):
+        os.remove(journal)
+    finished = set()
+    if os.path.exists(journal):
+        with open(journal) as journal_file:
+            for line in journal_file:
+                try:
+                    finished.add(json.loads(line)['zip'])
+                except (ValueError, KeyError):
+                    # The line being written when we were interrupted
+                    pass
+    zip_paths = [os.path.abspath(path) for path in zip_paths]
+    pending = [path for path in zip_paths if path not in finished]
+    debug("%d ZIPs to process, %d already done according to %s" % (
+        len(pending), len(zip_paths) - len(pending), journal
+    ))
+    if not pending:
+        return {}
+    # Unreadable ZIPs fail on their own, without taking the batch down or
+    # being given a number
+    sizes = {}
+    unreadable = []
+    for path in pending:
+        try:
+            sizes[path] = zip_size(path)
+        except (IOError, OSError, zipfile.BadZipfile) as exc:
+            debug('Unable to read "%s": %s' % (path, exc))
+            unreadable.append(path)
+    pending = [path for path in pending if path in sizes]
+    urls = dict((path, None) for path in unreadable)
+    if not pending:
+        return urls
+    pending.sort(key=lambda path: sizes[path], reverse=True)
+    first = get_counter().allocate(len(pending))
+
+    journal_lock = threading.Lock()
+    start = time.time()
+
+    def run(path, count):
+        try:
+            url = process_zip(path, count=count, **kwargs)
+        except Exception as exc:
+            debug('Failed to process "%s": %s' % (path, exc))
+            return None
+        with journal_lock:
+            with open(journal, 'a') as journal_file:
+                journal_file.write(json.dumps({'zip': path, 'url': url}) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        return url
+
+    from multiprocessing.pool import ThreadPool
+    batch_pool = ThreadPool(
+        jobs or config.get('processing', {}).get('concurrent_mixtapes', 1)
+    )
+    try:
+        results = [
+            (path, batch_pool.apply_async(run, (path, first + i)))
+            for i, path in enumerate(pending)
+        ]
+        urls.update((path, result.get()) for path, result in results)
+    finally:
+        batch_pool.close()
+    elapsed = max(time.time() - start, 0.001)
+    done = [path for path in pending if urls[path]]
+    size = sum(sizes[path] for path in done) / 1048576.0
+    debug("Processed %d of %d ZIPs, %.1fMB of MP3s in %.1fs: %.2f ZIPs/min, %.1fMB/s" % (
+        len(done), len(urls), size, elapsed, len(done) * 60 / elapsed,
+        size / elapsed
+    ))
+    for path in unreadable + pending:
+        if not urls[path]:
+            debug('Not processed: "%s"' % path)
+    return urls
 
 
 if __name__ == '__main__':
     # This block will get run only if this module is executed and not imported
     import argparse
+    import timing
+    timing.start_program()
     parser = argparse.ArgumentParser(description='Processes an approved\
         mixtape ZIP file and uploads it to S3')
-    parser.add_argument('zip_path', help='Path to the ZIP file to be processed')
+    parser.add_argument('zip_path', nargs='+', help='Path to the ZIP file to\
+        be processed, several of them or directories of them for a batch')
+    parser.add_argument('-l', '--list', help='File listing more ZIPs to be\
+        processed, one per line')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of ZIPs\
+        processed at once in a batch')
+    parser.add_argument('--journal', help='Where a batch records finished\
+        ZIPs, to resume after an interruption')
+    parser.add_argument('--restart', action="store_true", default=False,
+                        help="Forget the journal and process every ZIP again")
     parser.add_argument('-k', '--keep-dirs', action="store_true", default=False,
                         help="Keep the temporary directories instead of deleteing")
     parser.add_argument('-r', '--keep-orig', action="store_true",
@@ -438,4 +1188,9 @@ if __name__ == '__main__':
 
     # Process command line arguments
     args = vars(parser.parse_args())
-    process_zip(**args)
+    zip_paths = find_zips(args.pop('zip_path'), args.pop('list'))
+    batch_args = dict((key, args.pop(key)) for key in ('jobs', 'journal', 'restart'))
+    if len(zip_paths) == 1 and not batch_args['journal']:
+        process_zip(zip_paths[0], **args)
+    else:
+        process_batch(zip_paths, **dict(batch_args, **args))
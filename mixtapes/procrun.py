@@ -0,0 +1,97 @@
+import os
+import time
+
+from twisted.internet import protocol
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.task import LoopingCall
+
+from util import debug
+from procutil import KILL_GRACE, Result, Tail, read_proc_usage
+
+
+class CapturingProtocol(protocol.ProcessProtocol):
+    """
+    Keeps the tail of stderr, samples resource usage while the process
+    runs and fires finished with a Result when it exits
+    """
+    def __init__(self, result, max_stderr, sample_interval):
+        self.result = result
+        self.tail = Tail(max_stderr)
+        self.finished = Deferred()
+        self.sampler = LoopingCall(self.sample)
+        self.sample_interval = sample_interval
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+        self.sampler.start(self.sample_interval, now=False)
+
+    def sample(self):
+        pid = self.transport.pid
+        if pid:
+            cpu_time, max_rss = read_proc_usage(pid)
+            if cpu_time is not None:
+                self.result.cpu_time = cpu_time
+                self.result.max_rss = max_rss
+
+    def errReceived(self, data):
+        self.tail.write(data)
+
+    def processEnded(self, reason):
+        if self.sampler.running:
+            self.sampler.stop()
+        result = self.result
+        result.duration = time.time() - result.started
+        result.code = reason.value.exitCode
+        result.signal = reason.value.signal
+        result.stderr = self.tail.data
+        self.finished.callback(result)
+
+
+class ProcessRunner(object):
+    """
+    Runs external commands from the reactor, without holding a thread for
+    each of them. At most max_concurrent commands run at once, each is killed
+    once it runs for longer than its timeout, and the tail of its stderr is
+    kept. CPU time and peak RSS are sampled from /proc every sample_interval
+    seconds, so they only cover the process up to its last sample
+    """
+    def __init__(self, reactor, max_concurrent=16, timeout=3600,
+                 max_stderr=64 * 1024, sample_interval=1.0):
+        self.reactor = reactor
+        self.timeout = timeout
+        self.max_stderr = max_stderr
+        self.sample_interval = sample_interval
+        self.sem = DeferredSemaphore(max_concurrent)
+
+    def run(self, args, timeout=None):
+        """
+        Returns a Deferred that fires with the Result of running args
+        """
+        return self.sem.run(self.spawn, args, timeout or self.timeout)
+
+    def spawn(self, args, timeout):
+        result = Result(args)
+        proto = CapturingProtocol(result, self.max_stderr, self.sample_interval)
+        transport = self.reactor.spawnProcess(
+            proto, args[0], args, env=os.environ, childFDs={0: 'w', 1: 'r', 2: 'r'}
+        )
+        killer = self.reactor.callLater(timeout, self.kill, transport, result)
+
+        def cleanup(result):
+            if killer.active():
+                killer.cancel()
+            return result
+        return proto.finished.addBoth(cleanup)
+
+    def kill(self, transport, result):
+        debug("Killing %s after running too long" % result.args[0])
+        result.timed_out = True
+        self.signal(transport, 'TERM')
+        self.reactor.callLater(KILL_GRACE, self.signal, transport, 'KILL')
+
+    def signal(self, transport, name):
+        try:
+            transport.signalProcess(name)
+        except Exception:
+            # It already exited
+            pass
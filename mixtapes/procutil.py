@@ -0,0 +1,125 @@
+import os
+import time
+import threading
+import subprocess
+
+from util import debug
+
+
+# Grace period between SIGTERM and SIGKILL for processes that timed out
+KILL_GRACE = 5
+
+
+class Result(object):
+    """
+    What happened to an external command: its exit code (None if it was
+    killed by a signal), the tail of its stderr, how long it ran and, where
+    available, its CPU time and peak RSS in kilobytes
+    """
+    def __init__(self, args):
+        self.args = args
+        self.code = None
+        self.signal = None
+        self.timed_out = False
+        self.stderr = b''
+        self.started = time.time()
+        self.duration = None
+        self.cpu_time = None
+        self.max_rss = None
+
+    @property
+    def ok(self):
+        return self.code == 0
+
+    def describe(self):
+        if self.timed_out:
+            status = 'timed out'
+        elif self.code is None:
+            status = 'killed by signal %s' % self.signal
+        else:
+            status = 'exited with %s' % self.code
+        usage = '%.2fs' % (self.duration or 0)
+        if self.cpu_time is not None:
+            usage += ', %.2fs CPU' % self.cpu_time
+        if self.max_rss is not None:
+            usage += ', %dkB peak RSS' % self.max_rss
+        return '%s %s (%s)' % (os.path.basename(self.args[0]), status, usage)
+
+
+class Tail(object):
+    """
+    Keeps the last size bytes written to it
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = b''
+
+    def write(self, data):
+        self.data = (self.data + data)[-self.size:]
+
+
+def read_proc_usage(pid):
+    """
+    Returns (CPU seconds, peak RSS in kB) of a live process from /proc, or
+    (None, None) where /proc isn't available
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as stat_file:
+            # Fields after the command name, which may contain spaces
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        cpu_time = (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+        max_rss = None
+        with open('/proc/%d/status' % pid) as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    max_rss = int(line.split()[1])
+        return cpu_time, max_rss
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+
+
+def run_blocking(args, timeout=None, max_stderr=64 * 1024):
+    """
+    Runs args in a subprocess and waits for it, for when no reactor is running
+    The process is killed after timeout seconds
+    """
+    result = Result(args)
+    tail = Tail(max_stderr)
+    with open(os.devnull, 'wb') as devnull:
+        child = subprocess.Popen(args, stdout=devnull, stderr=subprocess.PIPE)
+
+    def kill():
+        result.timed_out = True
+        debug("Killing %s after %ss" % (args[0], timeout))
+        try:
+            child.terminate()
+            time.sleep(KILL_GRACE)
+            child.kill()
+        except OSError:
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        for chunk in iter(lambda: child.stderr.read(4096), b''):
+            tail.write(chunk)
+        # wait4 rather than wait, to get the resource usage of the child
+        _, status, usage = os.wait4(child.pid, 0)
+        child.returncode = status
+    finally:
+        if timer:
+            timer.cancel()
+        child.stderr.close()
+    result.duration = time.time() - result.started
+    result.cpu_time = usage.ru_utime + usage.ru_stime
+    result.max_rss = usage.ru_maxrss
+    if os.WIFSIGNALED(status):
+        result.signal = os.WTERMSIG(status)
+    else:
+        result.code = os.WEXITSTATUS(status)
+    result.stderr = tail.data
+    return result
@@ -0,0 +1,123 @@
+import time
+import threading
+
+from util import debug
+from db import get_pool
+
+
+class Entry(object):
+    """
+    A mixtape waiting to be published, and what happened when it was
+    """
+    def __init__(self, post_id, url, post_name):
+        self.post_id = post_id
+        self.url = url
+        self.post_name = post_name
+        self.done = threading.Event()
+        self.error = None
+
+
+def write_batch(cur, entries):
+    """
+    Publishes every entry with one set-based UPDATE per column
+    """
+    latest = {}
+    for entry in entries:
+        latest[entry.post_id] = entry.url
+    ids = list(latest)
+    marks = ', '.join(['%s'] * len(ids))
+    debug("Setting publish status for posts %s" % ids)
+    cur.execute(
+        'UPDATE tm1_posts SET post_status = %s WHERE ID IN (' + marks + ')',
+        ['publish'] + ids
+    )
+    debug("Setting ZIP URLs")
+    cases = []
+    for post_id in ids:
+        cases.extend([post_id, latest[post_id]])
+    cur.execute(
+        'UPDATE tm1_postmeta SET meta_value = CASE post_id ' +
+        ' '.join(['WHEN %s THEN %s'] * len(ids)) +
+        ' END WHERE meta_key = %s AND post_id IN (' + marks + ')',
+        cases + ['file_url'] + ids
+    )
+    debug("Setting zipping_status to processed")
+    cur.execute(
+        'UPDATE tm1_postmeta SET meta_value = %s '
+        'WHERE meta_key = %s AND post_id IN (' + marks + ')',
+        ['processed', 'zipping_status'] + ids
+    )
+
+
+class BatchPublisher(object):
+    """
+    Collects mixtapes finishing at about the same time and publishes them in a
+    single transaction. The first caller of a batch waits up to window seconds
+    (or until max_items have joined) and then writes the whole batch, while
+    the others wait for it. Mixtapes that may publish are counted between
+    begin and end, and the batch is written as soon as all of them have
+    joined, so a lone mixtape never waits. If the batch fails, its posts are
+    published one by one with publish_one so that each error lands on the
+    right post
+    """
+    def __init__(self, publish_one, window=2.0, max_items=20):
+        self.publish_one = publish_one
+        self.window = window
+        self.max_items = max_items
+        self.lock = threading.Condition()
+        self.pending = []
+        self.active = 0
+
+    def begin(self):
+        """ counts a mixtape that may publish before calling end """
+        with self.lock:
+            self.active += 1
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+            # The batch may not have anyone else left to wait for
+            self.lock.notify_all()
+
+    def full(self):
+        return len(self.pending) >= min(self.max_items, max(self.active, 1))
+
+    def publish(self, post_id, url, post_name=None):
+        """
+        Publishes post_id, returns once it is committed or raises its error
+        """
+        entry = Entry(post_id, url, post_name)
+        with self.lock:
+            self.pending.append(entry)
+            leader = len(self.pending) == 1
+            if self.full():
+                self.lock.notify_all()
+            if leader:
+                deadline = time.time() + self.window
+                while not self.full():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+                batch, self.pending = self.pending, []
+        if leader:
+            self.flush(batch)
+        entry.done.wait()
+        if entry.error is not None:
+            raise entry.error
+        debug("Post published: %s" % url)
+
+    def flush(self, batch):
+        debug("Publishing %d posts" % len(batch))
+        try:
+            get_pool().run(write_batch, batch)
+        except Exception as exc:
+            debug("Publishing batch failed: %s; publishing one by one" % exc)
+            for entry in batch:
+                try:
+                    self.publish_one(entry.post_id, entry.url, entry.post_name)
+                except Exception as exc:
+                    debug("Publishing post %s failed: %s" % (entry.post_id, exc))
+                    entry.error = exc
+        for entry in batch:
+            entry.done.set()
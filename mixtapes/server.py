@@ -1,5 +1,6 @@
 #!/usr/bin/python
 import sys
+import time
 
 
 class Log:
@@ -38,10 +39,18 @@ if __name__ == "__main__":
      output to given file instead of to STDOUT")
     parser.add_argument("--save-rest", action="store_false", default=False,
         help="Don't wipe the directory of non-ZIP files")
+    parser.add_argument("--status", action="store_true", default=False,
+        help="Print the queue depth and the progress of every job, then exit")
 
     # Makes a command line interface with arguments
     args = vars(parser.parse_args())
 
+    if args["status"]:
+        from jobqueue import get_job_queue
+        print(get_job_queue().report())
+        sys.exit(0)
+    del args["status"]
+
     if args["output"]:
         # if there is an output file passed
         output = open(args["output"], "a")
@@ -54,11 +63,15 @@ if __name__ == "__main__":
 
 
 from twisted.internet import reactor, protocol
-from twisted.internet.defer import DeferredQueue, DeferredSemaphore
+from twisted.protocols.basic import LineReceiver
+from twisted.web import resource, server
 from twisted.internet.threads import deferToThread
 from process import debug
 import process
-import os
+import metrics
+import jobqueue
+import youtube
+from counter import get_counter
 import json
 
 # A note about python syntax
@@ -69,32 +82,133 @@ import json
 # func(foo=1, bar=2, baz=3)
 
 
+def get_concurrency():
+    """
+    Number of mixtapes that may be processed at once, from settings.json
+    """
+    return process.config.get('processing', {}).get('concurrent_mixtapes', 1)
+
+
 class Processor():
     """
-    Whenever mixtapeReceived is called, deferToThread is scheduled to be run as
-    soon as a "slot" for being run is available. There is currently 1 slot
-    deferToThread runs process_mixtape in another thread, and releases the
-    slot when its that process is done
+    Mixtapes received are written to the durable job queue first. Whenever a
+    slot is free, the oldest queued job is claimed and deferToThread runs
+    process_mixtape in another thread. There are as many slots as
+    processing.concurrent_mixtapes in the settings (1 by default). Jobs that
+    were running when the server stopped are queued again on start, and
+    jobs waiting to be retried are started once their retry delay is over
     """
-    def __init__(self):
-        self.sem = DeferredSemaphore(1) #do one thing at a time
+    def __init__(self, queue):
+        self.queue = queue
+        self.slots = get_concurrency()
+        self.running = 0
+        self.wakeup = None
+
+    def start(self):
+        resumed = self.queue.recover()
+        if resumed:
+            debug("Resuming %d interrupted mixtapes" % resumed)
+        self.pump()
 
     def mixtapeReceived(self, mixtape):
-        debug("Adding %s to be processed" % mixtape)
-        self.sem.run(deferToThread, process.process_mixtape, *mixtape)
-        # DeferredSemaphore.run will not .release() until the defer returned by
-        # deferToThread fires
+        return self.submit(mixtape)[0]
+
+    def submit(self, post_ids):
+        """
+        Queues every post ID, returns (job id, state, whether it was queued
+        by this call) for each of them
+        """
+        debug("Adding %s to be processed" % post_ids)
+        results = self.queue.add_many(post_ids)
+        self.pump()
+        return results
+
+    def pump(self):
+        """
+        Starts queued jobs until every slot is taken
+        """
+        while self.running < self.slots:
+            job = self.queue.claim()
+            if job is None:
+                self.wakeAt(self.queue.next_available())
+                break
+            job_id, post_id, _ = job
+            debug("Starting job %s for mixtape %s" % (job_id, post_id))
+            self.running += 1
+            progress = lambda status, job_id=job_id: self.queue.set_progress(
+                job_id, status
+            )
+            d = deferToThread(process.process_mixtape, int(post_id), progress)
+            d.addCallbacks(self.jobDone, self.jobFailed,
+                           callbackArgs=(job_id,), errbackArgs=(job_id,))
+
+    def jobDone(self, result, job_id):
+        self.queue.finish(job_id)
+        self.release()
 
+    def jobFailed(self, failure, job_id):
+        debug("Error processing job %s: %s" % (job_id, failure.getTraceback()))
+        self.queue.fail(job_id, failure.getErrorMessage())
+        self.release()
+
+    def wakeAt(self, available):
+        """
+        Pumps again at available, when the next job waiting to be retried
+        becomes ready, instead of waiting for another job to come or go
+        """
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        self.wakeup = None
+        if available is not None:
+            self.wakeup = reactor.callLater(
+                max(0, available - time.time()), self.pump
+            )
 
-class AddToQueue(protocol.Protocol):
+    def release(self):
+        self.running -= 1
+        self.pump()
+
+
+def get_server_options():
+    return process.config.get('server', {})
+
+
+class AddToQueue(LineReceiver):
     """
     Whenever someone connects, an instance of this protocol is made that
     describes how to interact with them
+
+    Clients send one JSON object per line, and may keep the connection open
+    for as many as they like:
+
+        {"op": "submit", "ids": [123, 124]}
+            queues posts, each gets a line with its job handle:
+            {"id": 123, "job": 7, "state": "queued", "added": true}
+            a post whose job is running is queued again once it ends, with
+            "state": "running" and "added": true
+            or, while more than server.max_queued jobs are waiting:
+            {"id": 123, "error": "busy", "retry_after": 30}
+        {"op": "status", "jobs": [7]}
+            a line per job: {"job": 7, "post": "123", "state": "running",
+            "attempts": 1, "progress": "3/12 tracks", "error": null}
+        {"op": "queue"}
+            {"queued": 4, "running": 1, "done": 80, "failed": 0, "slots": 1,
+            "busy": false}
+
+    Messages that can't be understood get {"error": "..."}. A client whose
+    first message is a JSON list speaks the old form instead: a single
+    [post_id] followed by nothing, which gets "OK" (or the error) and the
+    connection closed
     """
-    processor = Processor()
+    processor = None
+    delimiter = b'\n'
+    # Leaves room for bulk submissions of thousands of IDs
+    MAX_LENGTH = 1024 * 1024
 
     def __init__(self):
-        self.info = ""
+        # What was received before the client could be told apart as
+        # speaking the old protocol or lines. None once it sends lines
+        self.first = b''
 
     def connectionMade(self):
         debug("Connection made")
@@ -102,56 +216,164 @@ class AddToQueue(protocol.Protocol):
     def dataReceived(self, data):
         """
         This method is called whenever the client sends data
-        We are trying to get a number enclosed in square braces, because that's
-        easy to parse using JSON (JavaScript Object Notation)
+        Lines only hold JSON objects, so a client starting with a list uses
+        the old protocol: a number enclosed in square braces, which is
+        handled once the list is complete, however it was split up
         """
+        if self.first is None:
+            return LineReceiver.dataReceived(self, data)
+        self.first += data
+        start = self.first.strip()
+        if not start:
+            return
+        if not start.startswith(b'['):
+            data, self.first = self.first, None
+            return LineReceiver.dataReceived(self, data)
+        if start.endswith(b']'):
+            self.first = None
+            return self.legacyReceived(start)
+        if len(self.first) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self.first)
+
+    def legacyReceived(self, data):
         debug("Data received: %s" % data)
-        self.info += data
-        if self.info.endswith("]"):
-            try:
-                # Parses the recieved information
-                info = json.loads(self.info)
-                # Verify that it's exactly what we want
-                if type(info[0]) is not int:
-                    raise Exception("ID %s is not int" % type(info[0]))
-                if len(info) is not 1:
-                    raise Exception("%s args, expected exactly 1" % len(info))
-                self.processor.mixtapeReceived(info)
-                self.transport.write("OK")
-            except (ValueError, IndexError, Exception) as e:
-                # In the case of JSON not being able to parse, in the case of
-                # info[0] not making sense, or in the case of my own errors
-                self.transport.write(e.message)
-                debug("Error!" + str(e))
-            finally:
-                debug("Ending connection")
-                self.transport.loseConnection()
+        try:
+            # Parses the recieved information
+            info = json.loads(data)
+            # Verify that it's exactly what we want
+            if type(info[0]) is not int:
+                raise Exception("ID %s is not int" % type(info[0]))
+            if len(info) is not 1:
+                raise Exception("%s args, expected exactly 1" % len(info))
+            self.processor.mixtapeReceived(info)
+            self.transport.write("OK")
+        except (ValueError, IndexError, Exception) as e:
+            # In the case of JSON not being able to parse, in the case of
+            # info[0] not making sense, or in the case of my own errors
+            self.transport.write(str(e))
+            debug("Error!" + str(e))
+        finally:
+            debug("Ending connection")
+            self.transport.loseConnection()
 
+    def reply(self, message):
+        self.sendLine(json.dumps(message))
 
-def verify_mixtape_counter():
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("expected a JSON object")
+            op = message.get('op')
+            if op == 'submit':
+                self.submit(message.get('ids'))
+            elif op == 'status':
+                self.status(message.get('jobs'))
+            elif op == 'queue':
+                self.reply(self.queueStatus())
+            else:
+                raise ValueError("unknown op %r" % op)
+        except Exception as e:
+            debug("Bad message %r: %s" % (line[:200], e))
+            self.reply({'error': str(e)})
+
+    def lineLengthExceeded(self, line):
+        self.transport.write(json.dumps({'error': 'message too long'}) + '\n')
+        self.transport.loseConnection()
+
+    def busy(self):
+        """
+        Whether server.max_queued jobs or more are waiting, if it's set
+        """
+        max_queued = get_server_options().get('max_queued', 0)
+        if not max_queued:
+            return False
+        return self.processor.queue.depth()[jobqueue.QUEUED] >= max_queued
+
+    def submit(self, ids):
+        if not isinstance(ids, list):
+            raise ValueError("ids must be a list")
+        valid = []
+        for post_id in ids:
+            if type(post_id) is int and post_id > 0:
+                valid.append(post_id)
+            else:
+                self.reply({'id': post_id, 'error': 'not a post ID'})
+        if not valid:
+            return
+        if self.busy():
+            retry_after = get_server_options().get('retry_after', 30)
+            for post_id in valid:
+                self.reply({'id': post_id, 'error': 'busy',
+                            'retry_after': retry_after})
+            return
+        results = self.processor.submit(valid)
+        for post_id, (job_id, state, added) in zip(valid, results):
+            self.reply({'id': post_id, 'job': job_id, 'state': state,
+                        'added': added})
+
+    def status(self, jobs):
+        if not isinstance(jobs, list):
+            raise ValueError("jobs must be a list")
+        for job_id in jobs:
+            job = self.processor.queue.job(job_id) if type(job_id) is int else None
+            if job is None:
+                self.reply({'job': job_id, 'error': 'unknown job'})
+                continue
+            job_id, key, state, attempts, progress, error, updated = job
+            self.reply({'job': job_id, 'post': key, 'state': state,
+                        'attempts': attempts, 'progress': progress,
+                        'error': error, 'updated': updated})
+
+    def queueStatus(self):
+        status = self.processor.queue.depth()
+        status['slots'] = self.processor.slots
+        status['busy'] = self.busy()
+        return status
+
+
+class Metrics(resource.Resource):
     """
-    Ensures that a mixtape.counter file exists at the path of the script
-    See process.Connection.__enter__ for better documentation of this stuff
+    Serves the metrics of this process in the Prometheus text format
     """
-    pathbase = os.path.dirname(__file__)
-    pathbase = pathbase if pathbase else '.'
+    isLeaf = True
 
-    try:
-        f = open(os.path.join(pathbase, "mixtapes.counter"), 'r')
-        int(f.read())
-    except (OSError, IOError, Exception):
-        f = open(os.path.join(pathbase, "mixtapes.counter"), 'w')
-        f.write("0")
-        f.close()
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.registry.render()
+
+
+def verify_mixtape_counter():
+    """
+    Ensures that a mixtapes.counter file exists in ROOT_DIR, where
+    process.Connection allocates mixtape numbers from
+    See counter.CounterAllocator for better documentation of this stuff
+    """
+    get_counter().ensure()
 
 
 def main():
     """This runs the the above on port 8000"""
     factory = protocol.ServerFactory()
     factory.protocol = AddToQueue
+    AddToQueue.processor = Processor(jobqueue.get_job_queue())
     reactor.listenTCP(8000,factory)
+    metrics_port = process.config.get('metrics', {}).get('port')
+    if metrics_port:
+        # Only reachable from this host, for a local Prometheus to scrape
+        reactor.listenTCP(metrics_port, server.Site(Metrics()),
+                          interface='127.0.0.1')
+    # Every slot of the Processor holds a thread for the whole mixtape
+    reactor.suggestThreadPoolSize(max(10, get_concurrency() + 2))
     verify_mixtape_counter()
     process.reactor = reactor
+    reactor.callWhenRunning(AddToQueue.processor.start)
+    if process.config.get('processing', {}).get('preview_video'):
+        # Videos are made on threads of their own, never holding a mixtape
+        reactor.callWhenRunning(youtube.get_lane().start)
     reactor.run()
     # Don't try to understand this.
 
@@ -159,6 +381,8 @@ def main():
 if __name__ == "__main__":
     # this next part will run main(), and always close output if it exists but
     # not raise an error if it does not
+    import timing
+    timing.start_program()
     process.args = args
     try:
         main()
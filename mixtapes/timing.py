@@ -1,15 +1,27 @@
 import atexit
-from time import clock
+try:
+    from time import perf_counter as clock
+except ImportError:
+    # time.clock measures CPU time on Linux, not wall time
+    from time import time as clock
 
 def secondsToStr(t):
     return "%d:%02d:%02d.%03d" % \
         reduce(lambda ll,b : divmod(ll[0],b) + ll[1:],
             [(t*1000,),1000,60,60])
 
+def since_start():
+    """
+    Seconds since start_program, as neither clock counts from the start
+    """
+    if start is None:
+        return 0
+    return clock() - start
+
 line = "="*40
 def log(s, elapsed=None):
     print line
-    print secondsToStr(clock()), '-', s
+    print secondsToStr(since_start()), '-', s
     if elapsed:
         print "Elapsed time:", elapsed
     print line
@@ -21,8 +33,16 @@ def endlog():
     log("End Program", secondsToStr(elapsed))
 
 def now():
-    return secondsToStr(clock())
+    return secondsToStr(since_start())
+
+start = None
 
-start = clock()
-atexit.register(endlog)
-log("Start Program")
+def start_program():
+    """
+    Logs the start of the program, and its end and run time when it exits
+    Nothing is logged unless this is called, so importing this is free
+    """
+    global start
+    start = clock()
+    atexit.register(endlog)
+    log("Start Program")
@@ -1,9 +1,12 @@
 import os
 import re
+import hashlib
+import threading
 import simplejson as json
 
 
-ROOT_DIR = '/export/brick1'
+# MIXTAPES_ROOT points everything at another tree, e.g. for a benchmark
+ROOT_DIR = os.environ.get('MIXTAPES_ROOT', '/export/brick1')
 
 
 def debug(msg, level=1):
@@ -15,28 +18,65 @@ def debug(msg, level=1):
         print(msg)
 
 
+config_cache = {}
+config_lock = threading.Lock()
+
+
 def get_config():
     """
     read configuration data from json file
 
     first tries to read settings.json file from outside source directory and
-    defaults to local_settings.json
+    defaults to local_settings.json. The file is only read again once its
+    modification time changes, and a change that can't be parsed keeps the
+    settings read last
     """
-    config = {}
+    json_file_path = os.path.join(ROOT_DIR, 'settings.json')
     try:
-        json_file_path = os.path.join(ROOT_DIR, 'settings.json')
-        with open(json_file_path, 'r') as config_file:
-            config = json.load(config_file)
-    except IOError:
+        mtime = os.path.getmtime(json_file_path)
+    except OSError:
         json_file_path = os.path.join(os.path.dirname(__file__), 'local_settings.json')
-        with open(json_file_path, 'r') as config_file:
-            config = json.load(config_file)
-    return config
+        mtime = os.path.getmtime(json_file_path)
+    key = (json_file_path, mtime)
+    if config_cache.get('key') != key:
+        with config_lock:
+            if config_cache.get('key') != key:
+                try:
+                    with open(json_file_path, 'r') as config_file:
+                        config_cache['config'] = json.load(config_file)
+                except ValueError as err:
+                    if 'config' not in config_cache:
+                        raise
+                    debug("ERROR reading %s, keeping the old settings: %s" % (
+                        json_file_path, err
+                    ))
+                config_cache['key'] = key
+    return config_cache['config']
+
+
+class LazyConfig(object):
+    """
+    The settings, for modules that keep them in a global: they are read on
+    first use rather than at import, and again whenever they change
+    """
+    def get(self, key, default=None):
+        return get_config().get(key, default)
+
+    def __getitem__(self, key):
+        return get_config()[key]
+
+    def __contains__(self, key):
+        return key in get_config()
 
 
-def get_filter_list():
+config = LazyConfig()
+
+
+FILTER_LIST_PATH = os.path.join(os.path.dirname(__file__), 'filter_list.json')
+
+
+def get_filter_list(json_file_path=FILTER_LIST_PATH):
     """ reads in a list of banned words from a json file and returns as a list """
-    json_file_path = os.path.join(os.path.dirname(__file__), 'filter_list.json')
     filter_list = []
     with open(json_file_path, 'r') as filter_file:
         try:
@@ -51,3 +91,99 @@ def filter_string(string, filter_list):
     for pattern, replacement in filter_list:
         string = re.sub(pattern, replacement, string)
     return string
+
+
+def can_merge(pattern):
+    """
+    Whether pattern matches the same inside an alternation with its
+    neighbours: it must not name or refer to its own groups, nor set global
+    flags
+    """
+    return not (
+        re.search(r'\\\d|\(\?P[<=]', pattern) or
+        re.match(r'\(\?[aiLmsux]+\)', pattern)
+    )
+
+
+def compile_filter_list(filter_list):
+    """
+    Compiles a filter list into a list of (prefilter, rules) groups, where
+    rules are the (regex, replacement) pairs of a run of consecutive patterns
+    and prefilter their alternation, or None for a single pattern.
+    The patterns of a group are still applied one after the other, since a
+    replacement can make a later pattern match, but only once its prefilter
+    finds one of them: a string without banned words is scanned once per
+    group instead of once per pattern, with the same result
+    """
+    runs = []
+    run = []
+    for pattern, replacement in filter_list:
+        if not can_merge(pattern):
+            if run:
+                runs.append(run)
+                run = []
+            runs.append([(pattern, replacement)])
+        else:
+            run.append((pattern, replacement))
+    if run:
+        runs.append(run)
+    groups = []
+    for run in runs:
+        prefilter = None
+        if len(run) > 1:
+            try:
+                prefilter = re.compile('|'.join('(?:%s)' % p for p, _ in run))
+            except (re.error, AssertionError) as exc:
+                # Python 2 asserts when they have over 100 groups between them
+                debug("Not prefiltering %d patterns: %s" % (len(run), exc))
+        groups.append((prefilter, [(re.compile(p), r) for p, r in run]))
+    return groups
+
+
+class FilterEngine(object):
+    """
+    The compiled patterns of a filter list file. The file is only parsed again
+    when its modification time changes. signature is a hash of the list, which
+    changes along with what the filter does
+    """
+    def __init__(self, path=FILTER_LIST_PATH):
+        self.path = path
+        self.mtime = None
+        self.rules = []
+        self.digest = None
+        self.lock = threading.Lock()
+
+    def reload(self):
+        """ recompiles the filter list if the file has changed since last time """
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    debug("Loading filter list from %s" % self.path)
+                    filter_list = get_filter_list(self.path)
+                    self.rules = compile_filter_list(filter_list)
+                    self.digest = hashlib.sha1(
+                        json.dumps(filter_list).encode('utf-8')).hexdigest()
+                    self.mtime = mtime
+        return self.rules
+
+    @property
+    def signature(self):
+        """ the hash of the filter list, loading it first if needed """
+        self.reload()
+        return self.digest
+
+    def filter(self, string):
+        """ replaces every banned word in string, None is left alone """
+        rules = self.reload()
+        if string is None:
+            return string
+        for prefilter, group in rules:
+            if prefilter is not None and not prefilter.search(string):
+                continue
+            for regex, replacement in group:
+                string = regex.sub(replacement, string)
+        return string
+
+
+filter_engine = FilterEngine()
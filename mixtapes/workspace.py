@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+
+from util import ROOT_DIR, debug, get_config
+
+
+workspace = None
+workspace_lock = threading.Lock()
+
+
+class Workspace(object):
+    """
+    Admits jobs into the working space under root only while what they are
+    estimated to need fits in its free space, keeping reserve bytes free.
+    Jobs that don't fit wait for others to finish, checking the free space
+    again every poll seconds. As the free space already excludes what running
+    jobs have written, while their whole estimates are still counted against
+    it, this errs on the side of caution. A job that would never fit is let
+    in once nothing else runs, rather than waiting forever
+    """
+    def __init__(self, root, reserve=0, overhead=0.25, poll=10):
+        self.root = root
+        self.reserve = reserve
+        self.overhead = overhead
+        self.poll = poll
+        self.claimed = 0
+        self.jobs = 0
+        self.cond = threading.Condition()
+
+    def free_space(self):
+        stat = os.statvfs(self.root)
+        return stat.f_bavail * stat.f_frsize
+
+    def estimate(self, infolist, copies=1):
+        """
+        Returns the bytes needed to process a ZIP with infolist: copies of its
+        MP3s, overhead times their size for the intermediates of the tracks in
+        flight, and its images
+        """
+        tracks = images = 0
+        for info in infolist:
+            name = info.filename.lower()
+            if name.endswith('mp3'):
+                tracks += info.file_size
+            elif name.endswith('jpg'):
+                images += info.file_size
+        return int(tracks * (copies + self.overhead)) + images
+
+    def admit(self, size, name):
+        """
+        Waits until size bytes can be spared for the job name, and sets them
+        aside. Every admit must be followed by a release of the same size
+        """
+        start = time.time()
+        logged = False
+        with self.cond:
+            while True:
+                available = self.free_space() - self.claimed - self.reserve
+                if size <= available:
+                    break
+                if not self.jobs:
+                    debug("%s needs %.1fMB but only %.1fMB are free, running it alone" % (
+                        name, size / 1048576.0, available / 1048576.0
+                    ))
+                    break
+                if not logged:
+                    debug("%s needs %.1fMB, %.1fMB are free, waiting for %d jobs" % (
+                        name, size / 1048576.0, available / 1048576.0, self.jobs
+                    ))
+                    logged = True
+                self.cond.wait(self.poll)
+            self.claimed += size
+            self.jobs += 1
+        waited = time.time() - start
+        if waited >= 1:
+            debug("%s waited %.1fs for disk space" % (name, waited))
+        return waited
+
+    def release(self, size):
+        with self.cond:
+            self.claimed -= size
+            self.jobs -= 1
+            self.cond.notify_all()
+
+
+def get_workspace():
+    """
+    Returns the manager of ROOT_DIR/output shared by every job of this
+    process, set up from workspace.reserve_mb, overhead and poll in the
+    settings
+    """
+    global workspace
+    with workspace_lock:
+        if workspace is None:
+            options = get_config().get('workspace', {})
+            workspace = Workspace(
+                os.path.join(ROOT_DIR, 'output'),
+                reserve=int(options.get('reserve_mb', 1024) * 1048576),
+                overhead=options.get('overhead', 0.25),
+                poll=options.get('poll', 10)
+            )
+    return workspace
@@ -0,0 +1,175 @@
+import os
+import json
+import errno
+import shutil
+import hashlib
+import threading
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+from util import ROOT_DIR, debug, get_config
+from jobqueue import JobQueue, FAILED
+from pipeline import get_stage, NETWORK
+from cache import link
+import metrics
+from metrics import timed
+
+
+lane = None
+lane_lock = threading.Lock()
+
+
+def queue_key(key):
+    """
+    Returns key with anything but ASCII percent-encoded, as JobQueue wants
+    """
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return str(quote(key, safe='/ '))
+
+
+class VideoLane(object):
+    """
+    Renders preview videos and uploads them to YouTube in the background, so
+    that no mixtape ever waits for either. Tracks are queued in their own
+    JobQueue along with a copy of their preview and cover in spool_dir, which
+    outlive the job's working directory. Queued videos are handed to the
+    youtube network stage, whose limits (pipeline.youtube in the settings)
+    decide how many are made at once. Failures are retried by the queue, and
+    whatever was queued while no lane ran is picked up by the next one to
+    start
+    """
+    def __init__(self, queue, spool_dir, poll=30):
+        self.queue = queue
+        self.spool_dir = spool_dir
+        self.poll = poll
+        self.cond = threading.Condition()
+
+    def spool_path(self, key):
+        digest = hashlib.sha1(key.encode('ascii')).hexdigest()
+        return os.path.join(self.spool_dir, digest)
+
+    def enqueue(self, key, preview_path, image_path, title, description):
+        """
+        Queues the video of key (e.g. mixtape number/track name), made from
+        the preview at preview_path and the still image at image_path, if any
+        """
+        key = queue_key(key)
+        spool = self.spool_path(key)
+        try:
+            os.makedirs(spool)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        payload = {
+            'preview': os.path.join(spool, 'preview.mp3'),
+            'image': None,
+            'video': os.path.join(spool, 'video.mp4'),
+            'title': title,
+            'description': description,
+        }
+        for path in (payload['preview'], payload['video']):
+            if os.path.exists(path):
+                os.remove(path)
+        link(preview_path, payload['preview'])
+        if image_path:
+            payload['image'] = os.path.join(spool, 'image.jpg')
+            if os.path.exists(payload['image']):
+                os.remove(payload['image'])
+            link(image_path, payload['image'])
+        result = self.queue.add(key, json.dumps(payload))
+        with self.cond:
+            self.cond.notify()
+        return result
+
+    def start(self):
+        """
+        Starts handing queued videos to the stage, after queueing again the
+        ones that were being made when the last lane stopped
+        """
+        resumed = self.queue.recover()
+        if resumed:
+            debug("Resuming %d interrupted videos" % resumed)
+        dispatcher = threading.Thread(target=self.dispatch, name='youtube')
+        dispatcher.daemon = True
+        dispatcher.start()
+
+    def dispatch(self):
+        stage = get_stage('youtube', NETWORK)
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                # Enqueue wakes us up, retries become ready on their own
+                with self.cond:
+                    self.cond.wait(self.poll)
+                continue
+            # Blocks while the stage is full, so videos stay queued on disk
+            stage.submit(self.run, *job)
+
+    def run(self, job_id, key, payload):
+        try:
+            self.make_video(key, json.loads(payload))
+        except Exception as exc:
+            debug("Video for %s failed: %s" % (key, exc))
+            metrics.videos_total.inc(result='error')
+            if self.queue.fail(job_id, exc) == FAILED:
+                # Won't be tried again unless it's queued anew, with new files
+                shutil.rmtree(self.spool_path(key), ignore_errors=True)
+        else:
+            metrics.videos_total.inc(result='ok')
+            self.queue.finish(job_id)
+            shutil.rmtree(self.spool_path(key), ignore_errors=True)
+
+    def make_video(self, key, payload):
+        """
+        Renders the video of a queued track and uploads it, raising if either
+        fails
+        """
+        # process imports this module, so it can't be imported at the top
+        from process import generate_video, upload_youtube
+        credentials = get_config().get('youtube', {})
+        debug("Making video for %s" % key)
+        if os.path.exists(payload['video']):
+            # Left over from an attempt that failed half way
+            os.remove(payload['video'])
+        with timed('video_render', scope='video'):
+            rendered = generate_video(
+                payload['preview'], payload['video'], image_path=payload['image']
+            )
+        if not rendered:
+            raise RuntimeError("rendering %s failed" % payload['video'])
+        with timed('video_upload', scope='video'):
+            uploaded = upload_youtube(
+                payload['video'],
+                credentials.get('user', ''),
+                credentials.get('password', ''),
+                payload['title'],
+                payload['description']
+            )
+        if not uploaded:
+            raise RuntimeError("uploading %s failed" % payload['video'])
+
+
+def get_lane():
+    """
+    Returns the video lane of this process, set up from the youtube section
+    of the settings: max_attempts, retry_delay, queue_path
+    (ROOT_DIR/youtube.db by default) and spool_dir (ROOT_DIR/youtube)
+    """
+    global lane
+    with lane_lock:
+        if lane is None:
+            options = get_config().get('youtube', {})
+            queue = JobQueue(
+                options.get('queue_path') or os.path.join(ROOT_DIR, 'youtube.db'),
+                table='videos',
+                max_attempts=options.get('max_attempts', 5),
+                retry_delay=options.get('retry_delay', 300)
+            )
+            lane = VideoLane(
+                queue,
+                options.get('spool_dir') or os.path.join(ROOT_DIR, 'youtube')
+            )
+    return lane